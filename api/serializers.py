@@ -1,3 +1,5 @@
+import hashlib
+
 from rest_framework import serializers
 from filesystem.models import DirectoryModel, FileModel
 from organizations.models import Organization
@@ -5,6 +7,7 @@ from django.db.transaction import atomic
 from django.core.files.uploadedfile import InMemoryUploadedFile
 
 from rag.models import RAG_FILE_TYPES, RAGFileProfile
+from rag.tasks import dispatch_rag_file_profile, ingestion_queue
 from celery import shared_task
 
 
@@ -55,16 +58,25 @@ class DirectoryCreateSerializer(serializers.ModelSerializer):
         return directory
 
 
+def file_content_hash(file) -> str:
+    content_hash = hashlib.sha256()
+    for chunk in file.chunks():
+        content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
 @shared_task
-def create_file_RAG_profile(file_id, organization_id):
+def create_file_RAG_profile(file_id, organization_id, queue=None):
     file = FileModel.objects.get(id=file_id)
     organization = Organization.objects.get(id=organization_id)
     print("Creating RAG profile for file: ", file_id,
           file.name, " in organization: ", organization_id)
-    RAGFileProfile.objects.create(
+    rag_file_profile = RAGFileProfile.objects.start(
         fileInstance=file,
         organization=organization,
     )
+    # the pages are ingested window by window in subtasks, on the same lane
+    dispatch_rag_file_profile(rag_file_profile, queue)
 
 
 class FileCreateSerializer(serializers.ModelSerializer):
@@ -96,13 +108,16 @@ class FileCreateSerializer(serializers.ModelSerializer):
             created_by=creator,
             organization=parent_directory.organization,
             file_size=file.size,
-            file_type=file.content_type.split('/')[1]
+            file_type=file.content_type.split('/')[1],
+            content_hash=file_content_hash(file)
         )
 
         # now we must create the rag file profile, IF it is a supported file type
 
         if fileInstance.file_type in RAG_FILE_TYPES:
-            create_file_RAG_profile.delay(
-                fileInstance.id, parent_directory.organization.id)
+            # small files go on the priority lane, ahead of large files and backfills
+            queue = ingestion_queue(fileInstance)
+            create_file_RAG_profile.apply_async(
+                (fileInstance.id, parent_directory.organization.id, queue), queue=queue)
 
         return fileInstance
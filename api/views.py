@@ -138,7 +138,7 @@ def get_directory_by_id(request, id):
             "created_at": file.created_at,
             "created_by": file.created_by.getName(),
             "file_size": file.file_size,
-            "embedded": file.rag_file_profile.exists(),
+            "embedded": file.rag_file_profile.filter(status='complete').exists(),
         })
 
     for sub_directory in directory.get_children():
@@ -39,6 +39,8 @@ class FileModel(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     file_size = models.IntegerField(default=0)
     file_type = models.CharField(max_length=10, default='')
+    # sha256 of the file content, files with the same content share their RAG pages
+    content_hash = models.CharField(max_length=64, default='', db_index=True)
     created_by = models.ForeignKey(
         User, on_delete=models.CASCADE, related_name='created_files')
     organization = models.ForeignKey(
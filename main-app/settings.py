@@ -3,6 +3,7 @@ from pathlib import Path
 import os
 from datetime import timedelta
 from dotenv import load_dotenv
+from kombu import Queue
 
 load_dotenv()
 
@@ -98,6 +99,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = "main-app.wsgi.application"
+ASGI_APPLICATION = "main-app.asgi.application"
 
 
 # Database
@@ -213,3 +215,135 @@ MEDIA_URL = '/media/'
 CELERY_BROKER_URL = 'redis://localhost:6379/0'  # URL for redis
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
+
+# CACHE CONFIG
+# shared between the web and celery workers, so cache entries and the RAG
+# index generation counters are seen by every process
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": "redis://localhost:6379/1",
+    },
+    # query embeddings and results, kept in their own redis instance because
+    # maxmemory and the eviction policy apply to a whole instance: bounding
+    # the one above would evict the celery broker messages, index generation
+    # counters, shard locks and semaphore slots. Start it bounded, e.g.
+    # redis-server --port 6380 --maxmemory 256mb --maxmemory-policy allkeys-lru
+    "rag-queries": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": "redis://localhost:6380/0",
+    },
+}
+
+# RAG CONFIG
+# memory budget of the per-process cache of organization embedding indexes
+RAG_INDEX_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# precision RAG page embeddings are stored at, 'float32' or 'float16'
+RAG_EMBEDDING_STORAGE_DTYPE = 'float32'
+
+# organizations with at least this many embeddings are searched with an
+# approximate IVF index instead of an exact scan
+RAG_ANN_MIN_CORPUS = 50000
+# number of IVF lists, None picks sqrt(number of embeddings)
+RAG_ANN_NLIST = None
+# number of IVF lists scanned per query, higher is slower with better recall
+RAG_ANN_NPROBE = 8
+# rebuild the IVF index once this fraction of embeddings was added after it
+RAG_ANN_REBUILD_FRACTION = 0.1
+
+# cache alias holding query embeddings and results
+RAG_QUERY_CACHE_ALIAS = "rag-queries"
+# seconds a query embedding stays cached
+RAG_QUERY_EMBEDDING_CACHE_TTL = 24 * 60 * 60
+# seconds query results stay cached, they are invalidated by the index
+# generation anyway, this only reclaims entries of old generations
+RAG_QUERY_RESULT_CACHE_TTL = 60 * 60
+
+# keep cached indexes as 'int8' or 'binary' codes instead of float32, None
+# disables quantization. Quantized indexes are never searched through IVF.
+RAG_INDEX_QUANTIZATION = None
+# pages rescored at full precision after a quantized first pass
+RAG_QUANTIZED_RESCORE_CANDIDATES = 50
+
+# keep a memory mapped embedding shard per organization on disk, shared by
+# every worker process, instead of loading embeddings from the database
+RAG_USE_SHARDS = True
+RAG_SHARD_ROOT = os.path.join(BASE_DIR, 'rag_shards')
+
+# fuse BM25 over page summaries with embedding similarity
+RAG_HYBRID_SEARCH = True
+# results taken from each ranking before fusing them
+RAG_HYBRID_CANDIDATES = 50
+# reciprocal rank fusion constant, higher flattens the rank weights
+RAG_RRF_K = 60
+# organizations with at least this many pages only score the embeddings of
+# the best RAG_LEXICAL_PRUNE_CANDIDATES lexical matches
+RAG_LEXICAL_PRUNE_MIN_PAGES = 20000
+RAG_LEXICAL_PRUNE_CANDIDATES = 1000
+
+# most queries accepted by a single batch query request
+RAG_MAX_BATCH_QUERIES = 32
+
+# threads scoring the organizations of a federated query in parallel
+RAG_FEDERATED_SEARCH_WORKERS = 8
+
+# page summaries requested concurrently by one ingestion task, and by every
+# ingestion task of every worker together
+RAG_SUMMARY_CONCURRENCY = 8
+RAG_SUMMARY_GLOBAL_CONCURRENCY = 32
+# PDF pages rendered at once, while the pages before them are summarized
+RAG_RENDER_WINDOW = 8
+# PDF pages whose text layer has at least this many characters are summarized
+# from their text, the other pages from an image by the vision model
+RAG_TEXT_LAYER_MIN_CHARS = 200
+
+# reuse the summaries and embeddings of identical files and pages within the
+# 'organization', or across all organizations with 'global'. None disables it
+RAG_DEDUPLICATION = 'organization'
+
+# store LLM summaries in the database and reuse them for identical requests
+RAG_LLM_CACHE_ENABLED = True
+# stored responses are evicted, least recently used first, past this size
+RAG_LLM_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+# resolution PDF pages are rendered at for the vision model, and the size in
+# pixels of their longest side once downscaled
+RAG_RENDER_DPI = 100
+RAG_RENDER_MAX_DIMENSION = 1568
+# format page images are sent in: 'JPEG', 'WEBP' or lossless 'PNG', and the
+# JPEG/WebP quality
+RAG_IMAGE_FORMAT = 'JPEG'
+RAG_IMAGE_QUALITY = 80
+
+# pages ingested by one Celery subtask, each window is stored as it completes
+# so a failed or restarted ingestion only redoes the missing windows
+RAG_INGEST_WINDOW = 16
+
+# ingestion lanes: files of at most RAG_PRIORITY_MAX_BYTES and
+# RAG_PRIORITY_MAX_PAGES pages go on the priority queue, the other files,
+# backfills and shard rebuilds on the bulk queue. Workers must consume both
+# lanes and the default queue (celery worker -Q rag-priority,rag-bulk,celery),
+# extra workers consuming only the priority queue (-Q rag-priority) keep small
+# uploads from waiting behind bulk ingestion
+RAG_PRIORITY_QUEUE = 'rag-priority'
+RAG_BULK_QUEUE = 'rag-bulk'
+RAG_PRIORITY_MAX_BYTES = 5 * 1024 * 1024
+RAG_PRIORITY_MAX_PAGES = 20
+# ingestion windows an organization runs at once, windows over the cap are
+# requeued after RAG_INGEST_DEFER_SECONDS so other organizations go first
+RAG_INGEST_ORG_CONCURRENCY = 4
+RAG_INGEST_DEFER_SECONDS = 5
+# seconds after which the slot of a crashed ingestion window is freed
+RAG_INGEST_SLOT_TIMEOUT = 30 * 60
+
+# celery queues: the default queue and the ingestion lanes above
+CELERY_TASK_DEFAULT_QUEUE = 'celery'
+CELERY_TASK_QUEUES = (
+    Queue(CELERY_TASK_DEFAULT_QUEUE),
+    Queue(RAG_PRIORITY_QUEUE),
+    Queue(RAG_BULK_QUEUE),
+)
+CELERY_TASK_ROUTES = {
+    'rag.tasks.rebuild_organization_shard': {'queue': RAG_BULK_QUEUE},
+}
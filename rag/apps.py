@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class RagConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "rag"
+
+    def ready(self):
+        # connect the signal handlers that keep the cached RAG indexes fresh
+        from rag import signals  # noqa: F401
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, OuterRef, Subquery
+
+from rag.models import RAGFileProfile, RAGPage
+from rag.utils.indexCache import bump_generation
+
+
+class Command(BaseCommand):
+    help = "Set the page count and complete status of RAG file profiles ingested before ingestion was resumable"
+
+    def handle(self, *args, **options):
+        # those profiles were ingested in one go, the pages they have are all their pages
+        profiles = RAGFileProfile.objects.filter(
+            page_count=0, id__in=RAGPage.objects.values('rag_file_profile_id'))
+        organization_ids = set(profiles.values_list('organization_id', flat=True))
+
+        stored_pages = RAGPage.objects.filter(rag_file_profile=OuterRef('pk')).order_by().values(
+            'rag_file_profile').annotate(count=Count('id')).values('count')
+        updated = profiles.update(page_count=Subquery(stored_pages), status='complete')
+
+        # their pages were hidden from the cached indexes and query results
+        for organization_id in organization_ids:
+            bump_generation(organization_id)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Completed {updated} RAG file profiles of {len(organization_ids)} organizations"))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.db.transaction import atomic
+
+from rag.models import RAGPage, RAGPagePosting
+from rag.utils.lexicalUtil import term_frequencies
+
+
+class Command(BaseCommand):
+    help = "Rebuild the BM25 postings of every RAG page from its summary"
+
+    def handle(self, *args, **options):
+        pages = RAGPage.objects.select_related('rag_file_profile').only(
+            'id', 'summary', 'rag_file_profile__organization_id')
+
+        page_count = 0
+        for page in pages.iterator():
+            token_count, frequencies = term_frequencies(page.summary)
+            with atomic():
+                RAGPagePosting.objects.filter(rag_page=page).delete()
+                RAGPagePosting.objects.bulk_create([
+                    RAGPagePosting(organization_id=page.rag_file_profile.organization_id, rag_page=page,
+                                   term=term, frequency=frequency)
+                    for term, frequency in frequencies.items()
+                ])
+                # update() skips the save signals, the embeddings are unchanged
+                RAGPage.objects.filter(id=page.id).update(token_count=token_count)
+            page_count += 1
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Indexed {page_count} RAG pages"))
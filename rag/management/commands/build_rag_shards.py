@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from organizations.models import Organization
+from rag.tasks import rebuild_organization_shard
+
+
+class Command(BaseCommand):
+    help = "Write the on-disk embedding shards of the given organizations, or of every organization"
+
+    def add_arguments(self, parser):
+        parser.add_argument('organization_ids', nargs='*')
+
+    def handle(self, *args, **options):
+        organization_ids = options['organization_ids'] or \
+            Organization.objects.values_list('id', flat=True)
+
+        for organization_id in organization_ids:
+            rebuild_organization_shard(organization_id)
+            self.stdout.write(f"Wrote shard of organization {organization_id}")
@@ -0,0 +1,46 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.transaction import atomic
+
+from rag.models import RAGPage
+from rag.utils.embeddingCodec import decode_embeddings, encode_embeddings, is_normalized
+from rag.utils.llmUtil import embedding_model
+
+
+class Command(BaseCommand):
+    help = "Rewrite RAG page embeddings still stored as JSON text or without L2 normalization in the current binary format"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        converted = 0
+
+        # only ids are held in memory, embeddings are read one batch at a time
+        page_ids = list(RAGPage.objects.values_list('id', flat=True))
+
+        for start in range(0, len(page_ids), batch_size):
+            batch_ids = page_ids[start:start + batch_size]
+            with atomic():
+                pages = RAGPage.objects.filter(id__in=batch_ids).only('id', 'embeddings')
+                outdated_pages = []
+                for page in pages:
+                    if is_normalized(page.embeddings):
+                        continue
+                    page.embeddings = encode_embeddings(
+                        decode_embeddings(page.embeddings),
+                        model=embedding_model,
+                        dtype=settings.RAG_EMBEDDING_STORAGE_DTYPE,
+                        normalize=True
+                    )
+                    outdated_pages.append(page)
+
+                # cached indexes normalize rows when they are built, so the
+                # rewritten values leave them valid and the save signals can
+                # be skipped
+                RAGPage.objects.bulk_update(outdated_pages, ['embeddings'])
+                converted += len(outdated_pages)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Converted {converted} of {len(page_ids)} RAG pages"))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from rag.utils.llmUtil import evict_llm_responses
+
+
+class Command(BaseCommand):
+    help = "Delete the least recently used stored LLM responses past RAG_LLM_CACHE_MAX_BYTES, or past --max-bytes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-bytes', type=int, default=None)
+
+    def handle(self, *args, **options):
+        deleted = evict_llm_responses(options['max_bytes'])
+        self.stdout.write(f"Deleted {deleted} stored LLM responses")
@@ -0,0 +1,52 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from rag.utils.annUtil import IVFIndex, recall_at_k
+from rag.utils.benchmarkUtil import sample_queries, time_queries
+from rag.utils.indexCache import build_organization_index
+from rag.utils.quantizeUtil import QuantizedIndex
+
+
+class Command(BaseCommand):
+    help = "Measure recall and latency of the approximate RAG index against the exact scan for an organization"
+
+    def add_arguments(self, parser):
+        parser.add_argument('organization_id')
+        parser.add_argument('--queries', type=int, default=100,
+                            help="number of stored embeddings reused as queries")
+        parser.add_argument('--top-k', type=int, default=5)
+        parser.add_argument('--nlist', type=int, default=settings.RAG_ANN_NLIST)
+        parser.add_argument('--nprobe', type=int, nargs='+',
+                            default=[1, 2, 4, 8, 16, 32])
+
+    def handle(self, *args, **options):
+        index, _ = build_organization_index(options['organization_id'])
+        if isinstance(index, QuantizedIndex):
+            self.stdout.write("Disable RAG_INDEX_QUANTIZATION to tune the IVF index")
+            return
+        if index.page_count == 0:
+            self.stdout.write("The organization has no RAG pages")
+            return
+
+        # train regardless of RAG_ANN_MIN_CORPUS so small orgs can be tuned too
+        start = time.perf_counter()
+        index = index.with_ann(IVFIndex.train(index.matrix, options['nlist']))
+        self.stdout.write(
+            f"{index.row_count} embeddings in {index.page_count} pages, "
+            f"{len(index.ann.centroids)} lists trained in {time.perf_counter() - start:.2f}s")
+
+        top_k = options['top_k']
+        queries = sample_queries(index, options['queries'])
+
+        exact_ms = time_queries(
+            lambda query: index.search(query, top_k, exact=True), queries)
+        self.stdout.write(f"exact: {exact_ms:.2f}ms per query")
+
+        for nprobe in options['nprobe']:
+            ann_ms = time_queries(
+                lambda query: index.search(query, top_k, nprobe=nprobe), queries)
+            recall = recall_at_k(index, queries, top_k, nprobe)
+            self.stdout.write(
+                f"nprobe={nprobe}: recall@{top_k}={recall:.3f}, {ann_ms:.2f}ms per query")
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from rag.utils.queryCache import query_embedding_cache_stats, query_result_cache_stats
+
+
+class Command(BaseCommand):
+    help = "Show the hit and miss counters of the RAG query caches"
+
+    def handle(self, *args, **options):
+        for name, stats in (("query embeddings", query_embedding_cache_stats()),
+                            ("query results", query_result_cache_stats())):
+            lookups = stats['hits'] + stats['misses']
+            hit_rate = stats['hits'] / lookups if lookups else 0
+            self.stdout.write(
+                f"{name}: {stats['hits']} hits, {stats['misses']} misses ({hit_rate:.1%} hit rate)")
@@ -0,0 +1,49 @@
+import base64
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from pdf2image import pdfinfo_from_path
+
+from rag.utils.ragUtil import IMAGE_MIME_TYPES, encode_image, render_pages
+
+
+class Command(BaseCommand):
+    help = "Report the bytes per page and render and encode times of PDF page images for each image setting"
+
+    def add_arguments(self, parser):
+        parser.add_argument('pdf_path')
+        parser.add_argument('--pages', type=int, default=5,
+                            help="number of pages rendered from the start of the PDF")
+        parser.add_argument('--dpi', type=int, nargs='+', default=[settings.RAG_RENDER_DPI])
+        parser.add_argument('--formats', nargs='+', default=list(IMAGE_MIME_TYPES),
+                            choices=list(IMAGE_MIME_TYPES))
+        parser.add_argument('--quality', type=int, nargs='+', default=[settings.RAG_IMAGE_QUALITY])
+        parser.add_argument('--max-dimension', type=int, nargs='+',
+                            default=[settings.RAG_RENDER_MAX_DIMENSION])
+
+    def handle(self, *args, **options):
+        pdf_path = options['pdf_path']
+        last_page = min(options['pages'], pdfinfo_from_path(pdf_path)['Pages'])
+
+        for dpi in options['dpi']:
+            start = time.perf_counter()
+            images = render_pages(pdf_path, 1, last_page, dpi)
+            render_ms = (time.perf_counter() - start) * 1000 / len(images)
+            self.stdout.write(f"{dpi} dpi: {render_ms:.0f}ms to render per page")
+
+            for max_dimension in options['max_dimension']:
+                for image_format in options['formats']:
+                    # quality does not change lossless PNG
+                    qualities = [None] if image_format == 'PNG' else options['quality']
+                    for quality in qualities:
+                        start = time.perf_counter()
+                        encoded = [encode_image(img.copy(), image_format, quality, max_dimension)
+                                   for img in images]
+                        encode_ms = (time.perf_counter() - start) * 1000 / len(images)
+                        page_bytes = sum(len(base64.b64decode(value)) for value in encoded) / len(images)
+
+                        label = image_format if quality is None else f"{image_format} q{quality}"
+                        self.stdout.write(
+                            f"  {label}, max {max_dimension}px: {page_bytes / 1024:.0f}KiB per page, "
+                            f"{encode_ms:.0f}ms to encode per page")
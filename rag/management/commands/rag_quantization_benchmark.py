@@ -0,0 +1,52 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from rag.utils.benchmarkUtil import overlap_at_k, sample_queries, time_queries
+from rag.utils.indexCache import build_organization_index
+from rag.utils.quantizeUtil import QUANTIZATION_MODES, QuantizedIndex
+
+
+class Command(BaseCommand):
+    help = "Compare memory use, recall and latency of the quantized RAG index modes for an organization"
+
+    def add_arguments(self, parser):
+        parser.add_argument('organization_id')
+        parser.add_argument('--queries', type=int, default=100,
+                            help="number of stored embeddings reused as queries")
+        parser.add_argument('--top-k', type=int, default=5)
+        parser.add_argument('--rescore-candidates', type=int, nargs='+',
+                            default=[settings.RAG_QUANTIZED_RESCORE_CANDIDATES])
+
+    def handle(self, *args, **options):
+        index, _ = build_organization_index(options['organization_id'])
+        if isinstance(index, QuantizedIndex):
+            self.stdout.write("Disable RAG_INDEX_QUANTIZATION to compare against the float32 index")
+            return
+        if index.page_count == 0:
+            self.stdout.write("The organization has no RAG pages")
+            return
+
+        top_k = options['top_k']
+        queries = sample_queries(index, options['queries'])
+        exact_results = [index.search(query, top_k, exact=True) for query in queries]
+        exact_ms = time_queries(
+            lambda query: index.search(query, top_k, exact=True), queries)
+        self.stdout.write(
+            f"float32: {index.nbytes / 2 ** 20:.1f}MiB, {exact_ms:.2f}ms per query")
+
+        # rescore from the float32 index in memory rather than the database,
+        # so the timings compare scoring only
+        rescore_loader = index.page_embeddings
+
+        for mode in QUANTIZATION_MODES:
+            for rescore_candidates in options['rescore_candidates']:
+                quantized = QuantizedIndex.from_index(
+                    index, mode, rescore_loader, rescore_candidates)
+                results = [quantized.search(query, top_k) for query in queries]
+                quantized_ms = time_queries(
+                    lambda query: quantized.search(query, top_k), queries)
+
+                self.stdout.write(
+                    f"{mode} (rescoring {rescore_candidates}): {quantized.nbytes / 2 ** 20:.1f}MiB "
+                    f"({index.nbytes / quantized.nbytes:.1f}x smaller), "
+                    f"recall@{top_k}={overlap_at_k(exact_results, results):.3f}, {quantized_ms:.2f}ms per query")
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from rag.models import RAGFileProfile
+from rag.tasks import dispatch_rag_file_profile
+
+
+class Command(BaseCommand):
+    help = "Queue the missing pages of every RAG file profile whose ingestion did not complete"
+
+    def handle(self, *args, **options):
+        for rag_file_profile in RAGFileProfile.objects.filter(status='processing'):
+            progress = rag_file_profile.progress()
+            dispatch_rag_file_profile(rag_file_profile)
+            self.stdout.write(
+                f"Resumed file {rag_file_profile.file_id}: {progress['pages_done']}/{progress['page_count']} pages done")
@@ -1,9 +1,15 @@
 import uuid
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
+from django.db.transaction import atomic
 
 from filesystem.models import FileModel
 from organizations.models import Organization
-from rag.utils.ragUtil import file_to_summaries, summary_to_embeddings
+from rag.utils.ragUtil import PageSummary, file_page_count, file_to_summaries, summaries_to_embeddings
+from rag.utils.llmUtil import embedding_model, evict_llm_responses
+from rag.utils.indexCache import append_profile_to_shard, bump_generation
+from rag.utils.embeddingCodec import encode_embeddings
+from rag.utils.lexicalUtil import MAX_TERM_LENGTH, term_frequencies
 
 
 RAG_FILE_TYPES = ['pdf', 'plain']
@@ -11,23 +17,183 @@ RAG_FILE_TYPES = ['pdf', 'plain']
 
 class RAGFileProfileManager(models.Manager):
     def create(self, fileInstance: FileModel, organization: Organization):
+        '''
+        Ingest a whole file at once. The Celery ingestion in rag.tasks goes
+        through start and ingest_pages instead, window by window.
+        '''
+        rag_file_profile = self.start(fileInstance, organization)
+        self.ingest_pages(rag_file_profile, 1, rag_file_profile.page_count)
+        return rag_file_profile
+
+    def start(self, fileInstance: FileModel, organization: Organization):
+        '''
+        The RAG file profile of a file, created with the page count of the
+        file if the file has none yet, so an interrupted ingestion resumes
+        with the pages it already stored
+        '''
         if fileInstance.file_type not in RAG_FILE_TYPES:
             raise ValueError(
                 f"File type {fileInstance.file_type} is not supported for RAG")
 
-        rag_file_profile = super().create(file=fileInstance, organization=organization)
+        rag_file_profile = self.filter(file=fileInstance).first()
+        if rag_file_profile is not None:
+            return rag_file_profile
+
+        return super().create(file=fileInstance, organization=organization,
+                              page_count=file_page_count(fileInstance))
+
+    def ingest_pages(self, rag_file_profile, first_page: int, last_page: int) -> bool:
+        '''
+        Summarize, embed and store the pages from first_page to last_page
+        (1-based, inclusive) not stored yet.
+
+        Every summary and embedding is computed first, then the pages and
+        their postings are bulk inserted in one short transaction, which also
+        marks the profile complete if they were its last missing pages.
+        Returns True if this call completed the profile.
+        '''
+        page_numbers = range(first_page - 1, last_page)
+        stored = set(rag_file_profile.rag_pages.filter(
+            page_number__in=page_numbers).values_list('page_number', flat=True))
+        if len(stored) == len(page_numbers):
+            return self.finish(rag_file_profile)
 
-        summaries = file_to_summaries(fileInstance)
+        fileInstance = rag_file_profile.file
+        organization = rag_file_profile.organization
 
-        for page_number, summary in enumerate(summaries):
-            RAGPage.objects.create(
+        # identical files reuse every page, identical pages reuse their summary
+        summaries = self.identical_file_summaries(fileInstance, organization, first_page, last_page)
+        if summaries is None or len(summaries) != len(page_numbers):
+            summaries = file_to_summaries(
+                fileInstance, self.page_finder(organization), first_page, last_page)
+
+        # only summaries not reused from another page need embeddings
+        to_embed = [i for i, page in enumerate(summaries) if page.embeddings is None]
+        new_embeddings = summaries_to_embeddings(
+            [summaries[i].summary for i in to_embed])
+        for i, page_embeddings in zip(to_embed, new_embeddings):
+            summaries[i] = summaries[i]._replace(embeddings=encode_embeddings(
+                page_embeddings,
+                model=embedding_model,
+                dtype=settings.RAG_EMBEDDING_STORAGE_DTYPE,
+                normalize=True
+            ))
+
+        rag_pages = []
+        postings = []
+        for page_number, page in zip(page_numbers, summaries):
+            token_count, frequencies = term_frequencies(page.summary)
+            rag_page = RAGPage(
                 rag_file_profile=rag_file_profile,
                 page_number=page_number,
-                summary=summary,
-                embeddings=summary_to_embeddings(summary)
+                summary=page.summary,
+                summary_source=page.source,
+                content_hash=page.content_hash,
+                token_count=token_count,
+                embeddings=page.embeddings
+            )
+            rag_pages.append(rag_page)
+            postings.extend(
+                RAGPagePosting(organization=organization, rag_page=rag_page,
+                               term=term, frequency=frequency)
+                for term, frequency in frequencies.items()
             )
 
-        return rag_file_profile
+        with atomic():
+            # serialize the windows of a file, so exactly one sees the file complete
+            self.select_for_update().filter(id=rag_file_profile.id).first()
+
+            # a retry racing with the first attempt may have stored some pages
+            stored = set(rag_file_profile.rag_pages.filter(
+                page_number__in=page_numbers).values_list('page_number', flat=True))
+            rag_pages = [rag_page for rag_page in rag_pages if rag_page.page_number not in stored]
+            postings = [posting for posting in postings if posting.rag_page.page_number not in stored]
+
+            RAGPage.objects.bulk_create(rag_pages, batch_size=500)
+            RAGPagePosting.objects.bulk_create(postings, batch_size=1000)
+            return self.finish(rag_file_profile)
+
+    def missing_pages(self, rag_file_profile) -> list[int]:
+        '''
+        The 1-based numbers of the pages of the file not stored yet
+        '''
+        stored = set(rag_file_profile.rag_pages.values_list('page_number', flat=True))
+        return [page_number + 1 for page_number in range(rag_file_profile.page_count)
+                if page_number not in stored]
+
+    def finish(self, rag_file_profile) -> bool:
+        '''
+        Mark the profile complete once every page is stored, which makes its
+        pages visible to queries, and publish them once the transaction
+        commits. Returns True only to the one caller that completed it.
+        '''
+        if self.missing_pages(rag_file_profile):
+            return False
+        completed = self.filter(id=rag_file_profile.id, status='processing').update(status='complete')
+        if completed:
+            rag_file_profile.status = 'complete'
+            # other processes must see the pages before the generation changes
+            transaction.on_commit(lambda: self.publish(rag_file_profile))
+        return completed == 1
+
+    def publish(self, rag_file_profile):
+        '''
+        Make the pages of a profile that was just completed searchable. They
+        were bulk inserted without the signals, so cached indexes and query
+        results do not have them yet.
+        '''
+        append_profile_to_shard(rag_file_profile)
+        bump_generation(rag_file_profile.organization_id)
+        # keep the stored LLM responses, grown by this file, within their size limit
+        evict_llm_responses()
+
+    def reusable_pages(self, organization: Organization):
+        '''
+        The pages whose summary and embeddings can be reused, following
+        RAG_DEDUPLICATION: within the organization, across all organizations
+        ('global'), or none at all (None)
+        '''
+        if not settings.RAG_DEDUPLICATION:
+            return RAGPage.objects.none()
+
+        pages = RAGPage.objects.exclude(content_hash='')
+        if settings.RAG_DEDUPLICATION != 'global':
+            pages = pages.filter(rag_file_profile__organization=organization)
+        return pages
+
+    def identical_file_summaries(self, fileInstance: FileModel, organization: Organization,
+                                 first_page: int, last_page: int) -> list[PageSummary]:
+        '''
+        The summaries of the pages from first_page to last_page (1-based,
+        inclusive) stored for another file with the same content, or None if
+        there is no such file
+        '''
+        if not fileInstance.content_hash:
+            return None
+
+        pages = self.reusable_pages(organization)
+        profile_id = pages.filter(
+            rag_file_profile__file__content_hash=fileInstance.content_hash
+        ).exclude(rag_file_profile__file=fileInstance).values_list('rag_file_profile_id', flat=True).first()
+        if profile_id is None:
+            return None
+
+        return [PageSummary(page.summary, page.summary_source, page.content_hash, page.embeddings)
+                for page in RAGPage.objects.filter(
+                    rag_file_profile_id=profile_id, page_number__range=(first_page - 1, last_page - 1)
+                ).order_by('page_number')]
+
+    def page_finder(self, organization: Organization):
+        pages = self.reusable_pages(organization)
+
+        def find_page(content_hash: str) -> PageSummary:
+            page = pages.filter(content_hash=content_hash).only(
+                'summary', 'summary_source', 'content_hash', 'embeddings').first()
+            if page is None:
+                return None
+            return PageSummary(page.summary, page.summary_source, page.content_hash, page.embeddings)
+
+        return find_page
 
 
 class RAGFileProfile(models.Model):
@@ -40,8 +206,21 @@ class RAGFileProfile(models.Model):
     organization = models.ForeignKey(
         'organizations.Organization', on_delete=models.CASCADE, related_name='rag_file_profiles')
 
+    # ingestion stores the pages window by window, the profile is complete
+    # once all page_count pages are stored
+    page_count = models.IntegerField(default=0)
+    status = models.CharField(max_length=10, choices=[
+        ('processing', 'Processing'), ('complete', 'Complete')], default='processing')
+
     objects = RAGFileProfileManager()
 
+    def progress(self) -> dict:
+        return {
+            'status': self.status,
+            'pages_done': self.rag_pages.count(),
+            'page_count': self.page_count,
+        }
+
 
 class RAGPage(models.Model):
     id = models.UUIDField(
@@ -56,9 +235,60 @@ class RAGPage(models.Model):
     # summary is the summary of the page, generated by the LLM
     summary = models.TextField(null=False, blank=False)
 
-    # embeddings is a list of embeddings for each token in the page
-    # in the format of [[embedding], [embedding], ...]
-    embeddings = models.JSONField(null=False, blank=False)
+    # what the summary was generated from: the text layer of the page, or an
+    # image of the page sent to the vision model
+    summary_source = models.CharField(max_length=8, choices=[
+        ('text', 'Text'), ('image', 'Image')], default='image')
+
+    # embeddings is the matrix of embeddings for each chunk of the page,
+    # packed by rag.utils.embeddingCodec.encode_embeddings
+    # read it with rag.utils.embeddingCodec.decode_embeddings
+    embeddings = models.BinaryField(null=False, blank=False)
+
+    # sha256 of the text or image the summary was made from, identical pages
+    # reuse the summary and embeddings instead of calling the LLM again
+    content_hash = models.CharField(max_length=64, default='', db_index=True)
+
+    # number of tokens in the summary, the document length used by BM25
+    token_count = models.IntegerField(default=0)
 
     class Meta:
         ordering = ['page_number']
+
+
+class RAGPagePosting(models.Model):
+    '''
+    One entry of the inverted index over RAG page summaries: how often a term
+    appears in a page. Organization is stored directly so lexical searches
+    never join through the file profiles.
+    '''
+    organization = models.ForeignKey(
+        'organizations.Organization', on_delete=models.CASCADE, related_name='rag_page_postings')
+    rag_page = models.ForeignKey(
+        RAGPage, on_delete=models.CASCADE, related_name='postings')
+    term = models.CharField(max_length=MAX_TERM_LENGTH)
+    frequency = models.IntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['organization', 'term']),
+        ]
+
+
+class LLMResponse(models.Model):
+    '''
+    A stored LLM response, reused for identical requests so retries and
+    re-ingestion do not pay for the same call twice.
+    See rag.utils.llmUtil.cached_response.
+    '''
+    id = models.UUIDField(
+        primary_key=True, default=uuid.uuid4, editable=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    # sha256 of the model, max_tokens, prompt hash and input hashes
+    key = models.CharField(max_length=64, unique=True)
+    model = models.CharField(max_length=128)
+    response = models.TextField()
+    # size of the response in bytes, evictions keep the total under a limit
+    size = models.IntegerField()
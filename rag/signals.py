@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from rag.models import RAGFileProfile, RAGPage
+from rag.tasks import rebuild_organization_shard
+from rag.utils.embeddingCodec import decode_normalized_embeddings
+from rag.utils.indexCache import bump_generation, index_cache
+
+
+@receiver(post_save, sender=RAGPage)
+def rag_page_saved(sender, instance: RAGPage, created: bool, **kwargs):
+    organization_id = str(instance.rag_file_profile.organization_id)
+    generation = bump_generation(organization_id)
+
+    if created:
+        index_cache.add_page(organization_id, generation,
+                             instance.id, decode_normalized_embeddings(instance.embeddings))
+    else:
+        index_cache.invalidate(organization_id)
+
+
+# RAGPage has no post_delete receiver: it would make Django load and delete
+# pages one by one. Pages are only deleted with their profile, whose receiver
+# bumps the generation once for all of them.
+@receiver(post_delete, sender=RAGFileProfile)
+def rag_file_profile_deleted(sender, instance: RAGFileProfile, **kwargs):
+    organization_id = str(instance.organization_id)
+    bump_generation(organization_id)
+    index_cache.invalidate(organization_id)
+
+    # shards are append only, removed pages need a rebuild
+    if settings.RAG_USE_SHARDS:
+        transaction.on_commit(
+            lambda: rebuild_organization_shard.delay(organization_id))
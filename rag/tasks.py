@@ -0,0 +1,84 @@
+from celery import shared_task
+from django.conf import settings
+from pdf2image.exceptions import PDFPageCountError, PDFSyntaxError
+
+from rag.models import RAGFileProfile
+from rag.utils.indexCache import bump_generation, train_shard_ann, write_organization_shard
+from rag.utils.ragUtil import file_page_count
+from rag.utils.shardUtil import shard_lock
+from rag.utils.throttleUtil import acquire_slot, release_slot
+
+
+@shared_task
+def rebuild_organization_shard(organization_id):
+    with shard_lock(organization_id):
+        write_organization_shard(organization_id)
+    train_shard_ann(organization_id)
+    bump_generation(organization_id)
+
+
+def ingestion_queue(fileInstance) -> str:
+    '''
+    The lane of a file's ingestion: the priority queue for small files, the
+    bulk queue for large ones and files whose page count cannot be read
+    '''
+    if fileInstance.file_size > settings.RAG_PRIORITY_MAX_BYTES:
+        return settings.RAG_BULK_QUEUE
+    try:
+        page_count = file_page_count(fileInstance)
+    except (PDFPageCountError, PDFSyntaxError):
+        return settings.RAG_BULK_QUEUE
+    if page_count > settings.RAG_PRIORITY_MAX_PAGES:
+        return settings.RAG_BULK_QUEUE
+    return settings.RAG_PRIORITY_QUEUE
+
+
+def dispatch_rag_file_profile(rag_file_profile, queue: str = None):
+    '''
+    Queue an ingestion subtask on the given queue (the bulk queue by default)
+    for every window of RAG_INGEST_WINDOW pages that still has pages to
+    store, or finish the profile if none has
+    '''
+    queue = queue or settings.RAG_BULK_QUEUE
+    window = settings.RAG_INGEST_WINDOW
+    windows = sorted({(page - 1) // window for page in RAGFileProfile.objects.missing_pages(rag_file_profile)})
+    if not windows:
+        RAGFileProfile.objects.finish(rag_file_profile)
+        return
+
+    for i in windows:
+        first_page = i * window + 1
+        ingest_rag_file_window.apply_async((
+            rag_file_profile.id, first_page, min(first_page + window - 1, rag_file_profile.page_count), queue
+        ), queue=queue)
+
+
+@shared_task(autoretry_for=(Exception,), retry_backoff=True, max_retries=5)
+def ingest_rag_file_window(rag_file_profile_id, first_page, last_page, queue=None):
+    '''
+    Store the pages of a window of a file, and finish the profile if they
+    were its last missing pages. Retries only redo the pages not stored yet,
+    and the stored LLM responses make redone pages cheap.
+
+    An organization runs at most RAG_INGEST_ORG_CONCURRENCY windows at once.
+    Windows over the cap are sent back to the end of their queue, so the
+    windows of other organizations run in between.
+    '''
+    rag_file_profile = RAGFileProfile.objects.filter(id=rag_file_profile_id).first()
+    if rag_file_profile is None:
+        # the file was deleted meanwhile
+        return
+
+    slot = acquire_slot(f"ingest:{rag_file_profile.organization_id}",
+                        settings.RAG_INGEST_ORG_CONCURRENCY, settings.RAG_INGEST_SLOT_TIMEOUT)
+    if slot is None:
+        queue = queue or settings.RAG_BULK_QUEUE
+        ingest_rag_file_window.apply_async(
+            (rag_file_profile_id, first_page, last_page, queue),
+            queue=queue, countdown=settings.RAG_INGEST_DEFER_SECONDS)
+        return
+
+    try:
+        RAGFileProfile.objects.ingest_pages(rag_file_profile, first_page, last_page)
+    finally:
+        release_slot(slot)
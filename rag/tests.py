@@ -1,3 +1,756 @@
-from django.test import TestCase
+import io
+import json
+import tempfile
+import uuid
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from filesystem.models import FileModel
+from organizations.models import Organization
+from rag.models import LLMResponse, RAGFileProfile, RAGPage, RAGPagePosting
+from rag.tasks import dispatch_rag_file_profile, ingest_rag_file_window, ingestion_queue
+from rag.utils.annUtil import IVFIndex, recall_at_k
+from rag.utils.embeddingCodec import decode_embeddings, decode_normalized_embeddings, encode_embeddings, is_normalized, read_header
+from rag.utils.indexCache import IndexCache, build_organization_index, bump_generation, get_generation, load_organization_pages, train_shard_ann
+from rag.utils.indexUtil import EmbeddingIndex
+from rag.utils.lexicalUtil import bm25_search, corpus_stats, reciprocal_rank_fusion, term_frequencies, tokenize
+from rag.utils.llmUtil import cached_response, evict_llm_responses, generate_embeddings_batch
+from rag.utils.quantizeUtil import QuantizedIndex
+from rag.utils.ragUtil import PageSummary, page_hash, pdf_to_summaries_per_page
+from rag.utils.shardUtil import append_to_shard, open_shard, write_shard
+from rag.utils.queryCache import get_query_embeddings, get_query_results, query_embedding_cache_stats, set_query_results
+from rag.utils.searchUtil import directory_page_ids, search_organizations
+from rag.utils.throttleUtil import acquire_slot, release_slot
+from rag.views import QUERY_TOP_K, add_page_details, query_scope
+from rest_framework_simplejwt.tokens import AccessToken
+from users.models import User
+
+LOCMEM_CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "rag-queries": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+}
+
+
+def naive_scores(query_embeddings, pages):
+    # reference implementation: the original per-pair cosine similarity loop
+    scores = {}
+    for page_id, embeddings in pages:
+        for embedding in embeddings:
+            score = 0
+            for query_embedding in query_embeddings:
+                a, b = np.array(query_embedding), np.array(embedding)
+                score += np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
+            scores[page_id] = max(scores.get(page_id, -np.inf), score)
+    return scores
+
+
+class EmbeddingIndexTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.pages = [
+            (f"page-{i}", rng.normal(size=(rng.integers(1, 4), 16)).tolist())
+            for i in range(50)
+        ]
+        self.query = rng.normal(size=(2, 16)).tolist()
+
+    def test_search_matches_naive_scores(self):
+        index = EmbeddingIndex.from_pages(self.pages)
+        expected = naive_scores(self.query, self.pages)
+        expected_order = sorted(expected, key=expected.get, reverse=True)[:5]
+
+        results = index.search(self.query, top_k=5)
+
+        self.assertEqual([r['rag_page_id'] for r in results], expected_order)
+        for result in results:
+            self.assertAlmostEqual(
+                result['similarity_score'], expected[result['rag_page_id']], places=4)
+
+    def test_empty_index(self):
+        index = EmbeddingIndex.from_pages([])
+        self.assertEqual(index.search(self.query), [])
+
+    def test_page_mask_restricts_results(self):
+        index = EmbeddingIndex.from_pages(self.pages)
+        scope = [page_id for page_id, _ in self.pages[10:20]] + ['unknown-page']
+        expected = naive_scores(self.query, self.pages[10:20])
+
+        results = index.search(self.query, top_k=20, page_mask=index.page_mask(scope))
+
+        self.assertEqual(len(results), 10)
+        for result in results:
+            self.assertAlmostEqual(
+                result['similarity_score'], expected[result['rag_page_id']], places=4)
+
+    def test_search_batch_matches_search(self):
+        index = EmbeddingIndex.from_pages(self.pages)
+        rng = np.random.default_rng(1)
+        queries = [rng.normal(size=(2, 16)).tolist() for _ in range(4)]
+        page_mask = index.page_mask([page_id for page_id, _ in self.pages[5:30]])
+
+        for mask in (None, page_mask):
+            batch = index.search_batch(queries, top_k=5, page_mask=mask)
+            for query, results in zip(queries, batch):
+                expected = index.search(query, top_k=5, page_mask=mask)
+                self.assertEqual([r['rag_page_id'] for r in results],
+                                 [r['rag_page_id'] for r in expected])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class IndexCacheTests(SimpleTestCase):
+    def build(self, organization_id):
+        return EmbeddingIndex.from_pages([(f"{organization_id}-page", [[1.0, 0.0]])]), None
+
+    def test_cached_until_generation_changes(self):
+        cache = IndexCache(max_bytes=10 ** 6)
+        with mock.patch('rag.utils.indexCache.build_organization_index', side_effect=self.build) as build:
+            first = cache.get('org-a')
+            self.assertIs(cache.get('org-a'), first)
+            self.assertEqual(build.call_count, 1)
+
+            bump_generation('org-a')
+            cache.get('org-a')
+            self.assertEqual(build.call_count, 2)
+
+    def test_add_page_patches_current_index(self):
+        cache = IndexCache(max_bytes=10 ** 6)
+        with mock.patch('rag.utils.indexCache.build_organization_index', side_effect=self.build) as build:
+            cache.get('org-b')
+            cache.add_page('org-b', bump_generation('org-b'),
+                           'new-page', [[0.0, 1.0]])
+            index = cache.get('org-b')
+
+            self.assertEqual(build.call_count, 1)
+            self.assertEqual(index.page_ids, ['org-b-page', 'new-page'])
+            self.assertEqual(index.search([[0.0, 1.0]], top_k=1)[
+                             0]['rag_page_id'], 'new-page')
+
+    def test_evicts_least_recently_used(self):
+        size = self.build('org')[0].nbytes
+        cache = IndexCache(max_bytes=2 * size)
+        with mock.patch('rag.utils.indexCache.build_organization_index', side_effect=self.build) as build:
+            cache.get('org-1')
+            cache.get('org-2')
+            cache.get('org-1')
+            cache.get('org-3')  # evicts org-2
+            cache.get('org-1')
+            self.assertEqual(build.call_count, 3)
+            cache.get('org-2')
+            self.assertEqual(build.call_count, 4)
+
+    def test_extends_index_from_shard(self):
+        shard_root = tempfile.TemporaryDirectory()
+        self.addCleanup(shard_root.cleanup)
+        pages = [(uuid.uuid4(), [[1.0, 0.0]]), (uuid.uuid4(), [[0.0, 1.0]])]
+        cache = IndexCache(max_bytes=10 ** 6)
+
+        with override_settings(RAG_SHARD_ROOT=shard_root.name, RAG_USE_SHARDS=True, RAG_INDEX_QUANTIZATION=None), \
+                mock.patch('rag.utils.indexCache.open_shard', wraps=open_shard) as opened:
+            write_shard('org-s', pages[:1], dim=2)
+            cache.get('org-s')
+            # an ingestion worker appends a file's pages, then bumps the generation
+            append_to_shard('org-s', pages[1:])
+            bump_generation('org-s')
+            index = cache.get('org-s')
+
+        self.assertEqual(opened.call_count, 1)
+        self.assertEqual(index.page_ids, [page_id for page_id, _ in pages])
+        self.assertEqual(index.search([[0.0, 1.0]], top_k=1)[0]['rag_page_id'], pages[1][0])
+
+
+@override_settings(RAG_INDEX_QUANTIZATION=None)
+class IndexCommandTests(SimpleTestCase):
+    def run_command(self, name, *args) -> str:
+        rng = np.random.default_rng(5)
+        index = EmbeddingIndex.from_pages([(f"page-{i}", rng.normal(size=(2, 16))) for i in range(50)])
+        out = io.StringIO()
+        with mock.patch(f'rag.management.commands.{name}.build_organization_index', return_value=(index, None)):
+            call_command(name, 'org', '--queries', '5', *args, stdout=out)
+        return out.getvalue()
+
+    def test_ann_recall(self):
+        self.assertIn("nprobe=4: recall@5=", self.run_command('rag_ann_recall', '--nprobe', '4'))
+
+    def test_quantization_benchmark(self):
+        output = self.run_command('rag_quantization_benchmark')
+        self.assertIn("int8 (rescoring", output)
+        self.assertIn("binary (rescoring", output)
+
+
+class EmbeddingCodecTests(SimpleTestCase):
+    def setUp(self):
+        self.embeddings = np.random.default_rng(1).normal(size=(3, 8)).tolist()
+
+    def test_round_trip(self):
+        encoded = encode_embeddings(self.embeddings, model='test-model')
+        header = read_header(encoded)
+
+        self.assertEqual((header.count, header.dim, header.model), (3, 8, 'test-model'))
+        np.testing.assert_allclose(
+            decode_embeddings(encoded), self.embeddings, rtol=1e-6)
+
+    def test_float16_storage(self):
+        encoded = encode_embeddings(self.embeddings, dtype='float16')
+        decoded = decode_embeddings(encoded)
+
+        self.assertEqual(decoded.dtype, np.float32)
+        np.testing.assert_allclose(decoded, self.embeddings, atol=1e-2)
+
+    def test_normalized_storage(self):
+        encoded = encode_embeddings(self.embeddings, normalize=True)
+
+        self.assertTrue(is_normalized(encoded))
+        self.assertFalse(is_normalized(encode_embeddings(self.embeddings)))
+        np.testing.assert_allclose(
+            np.linalg.norm(decode_normalized_embeddings(encoded), axis=1), 1, rtol=1e-6)
+
+    def test_reads_legacy_json(self):
+        decoded = decode_embeddings(json.dumps(self.embeddings))
+        np.testing.assert_allclose(decoded, self.embeddings, rtol=1e-6)
+
+
+class IVFIndexTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(2)
+        # clustered data, like real embeddings, so coarse lists are meaningful
+        centers = rng.normal(size=(20, 32))
+        self.pages = [
+            (f"page-{i}", centers[i % 20] + rng.normal(scale=0.3, size=(2, 32)))
+            for i in range(1000)
+        ]
+        self.queries = [[centers[i % 20] + rng.normal(scale=0.3, size=32)]
+                        for i in range(20)]
+        index = EmbeddingIndex.from_pages(self.pages)
+        self.index = index.with_ann(IVFIndex.train(index.matrix, nlist=20))
+
+    def test_probing_every_list_is_exact(self):
+        self.assertEqual(recall_at_k(self.index, self.queries, nprobe=20), 1.0)
+
+    def test_recall_with_few_probes(self):
+        self.assertGreater(recall_at_k(self.index, self.queries, nprobe=4), 0.8)
+
+    def test_appended_pages_are_searched(self):
+        index = self.index.with_page('new-page', [[1.0] * 32])
+        results = index.search([[1.0] * 32], top_k=1, nprobe=1)
+        self.assertEqual(results[0]['rag_page_id'], 'new-page')
+
+
+class QuantizedIndexTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        self.pages = [(f"page-{i}", rng.normal(size=(2, 64)))
+                      for i in range(500)]
+        self.queries = [rng.normal(size=(1, 64)) for _ in range(10)]
+        self.index = EmbeddingIndex.from_pages(self.pages)
+        self.loaded = []
+
+    def quantized(self, mode, rescore_candidates=100):
+        def loader(page_ids):
+            self.loaded.append(len(page_ids))
+            positions = {page_id: i for i, page_id in enumerate(self.index.page_ids)}
+            return [(page_id, self.index.matrix[2 * positions[page_id]:2 * positions[page_id] + 2])
+                    for page_id in page_ids]
+        return QuantizedIndex.from_index(self.index, mode, loader, rescore_candidates)
+
+    def test_int8_matches_exact_search(self):
+        quantized = self.quantized('int8')
+        self.assertEqual(quantized.codes.nbytes, self.index.matrix.nbytes / 4)
+        for query in self.queries:
+            results = quantized.search(query)
+            expected = self.index.search(query)
+            self.assertEqual([r['rag_page_id'] for r in results],
+                             [r['rag_page_id'] for r in expected])
+            for result, expected_result in zip(results, expected):
+                self.assertAlmostEqual(
+                    result['similarity_score'], expected_result['similarity_score'], places=5)
+        self.assertEqual(self.loaded, [100] * len(self.queries))
+
+    def test_page_mask(self):
+        quantized = self.quantized('int8')
+        scope = [page_id for page_id, _ in self.pages[:20]]
+        for query in self.queries:
+            results = quantized.search(query, page_mask=quantized.page_mask(scope))
+            self.assertEqual([r['rag_page_id'] for r in results],
+                             [r['rag_page_id'] for r in self.index.subset(scope).search(query)])
+
+    def test_binary_recall(self):
+        quantized = self.quantized('binary', rescore_candidates=200)
+        self.assertEqual(quantized.codes.nbytes, self.index.matrix.nbytes / 32)
+        hits = sum(len({r['rag_page_id'] for r in quantized.search(query)} &
+                       {r['rag_page_id'] for r in self.index.search(query)})
+                   for query in self.queries)
+        self.assertGreaterEqual(hits / (5 * len(self.queries)), 0.8)
+
+
+class LexicalTests(SimpleTestCase):
+    def test_tokenize_keeps_identifiers(self):
+        self.assertEqual(tokenize("The XJ-2045 pump, rev v1.2.3 of the Manual"),
+                         ['xj-2045', 'pump', 'rev', 'v1.2.3', 'manual'])
+
+    def test_term_frequencies(self):
+        token_count, frequencies = term_frequencies("Valve A, valve B and valve C")
+        self.assertEqual(token_count, 5)
+        self.assertEqual(frequencies['valve'], 3)
+
+    def test_reciprocal_rank_fusion(self):
+        fused = reciprocal_rank_fusion([['a', 'b', 'c'], ['c', 'b']], k=1)
+        self.assertEqual([item_id for item_id, _ in fused], ['c', 'b', 'a'])
+        self.assertAlmostEqual(fused[0][1], 1 / 4 + 1 / 2)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CorpusStatsTests(SimpleTestCase):
+    def test_cached_until_generation_changes(self):
+        with mock.patch('rag.utils.lexicalUtil.apps.get_model') as get_model:
+            aggregate = get_model.return_value.objects.filter.return_value.aggregate
+            aggregate.return_value = {'page_count': 3, 'average_length': None}
+
+            self.assertEqual(corpus_stats('org'), (3, 1))
+            corpus_stats('org')
+            self.assertEqual(aggregate.call_count, 1)
+
+            bump_generation('org')
+            corpus_stats('org')
+            self.assertEqual(aggregate.call_count, 2)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class QueryEmbeddingCacheTests(SimpleTestCase):
+    def test_repeated_query_is_embedded_once(self):
+        with mock.patch('rag.utils.queryCache.generate_embeddings_batch', return_value=[[[0.5, 0.25]]]) as generate:
+            first = get_query_embeddings("Quarterly  revenue")
+            second = get_query_embeddings("quarterly revenue ")
+
+        self.assertEqual(generate.call_count, 1)
+        np.testing.assert_array_equal(first, second)
+        self.assertEqual(query_embedding_cache_stats(), {'hits': 1, 'misses': 1})
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class QueryResultCacheTests(SimpleTestCase):
+    def test_results_cached_until_generation_changes(self):
+        key, results = get_query_results('org', "Quarterly revenue", 5)
+        self.assertIsNone(results)
+        set_query_results(key, [{'rag_page_id': 'page'}])
+
+        self.assertEqual(get_query_results('org', "quarterly  revenue", 5)[1], [{'rag_page_id': 'page'}])
+        self.assertIsNone(get_query_results('org', "quarterly revenue", 5, scope='directory')[1])
+        self.assertIsNone(get_query_results('org', "quarterly revenue", 10)[1])
+
+        bump_generation('org')
+        self.assertIsNone(get_query_results('org', "quarterly revenue", 5)[1])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ShardTests(SimpleTestCase):
+    def setUp(self):
+        shard_root = tempfile.TemporaryDirectory()
+        self.addCleanup(shard_root.cleanup)
+        self.enterContext(override_settings(RAG_SHARD_ROOT=shard_root.name))
+
+        rng = np.random.default_rng(4)
+        self.pages = [(uuid.uuid4(), EmbeddingIndex.from_pages([('page', rng.normal(size=(2, 8)))]).matrix)
+                      for _ in range(5)]
+
+    def test_missing_shard(self):
+        self.assertIsNone(open_shard('org'))
+        self.assertFalse(append_to_shard('org', self.pages))
+
+    def test_write_append_and_load(self):
+        write_shard('org', self.pages[:3], dim=8)
+        self.assertTrue(append_to_shard('org', self.pages[2:]))
+
+        index = open_shard('org')[0]
+        expected = EmbeddingIndex.from_pages(self.pages, normalized=True)
+
+        self.assertIsInstance(index.matrix, np.memmap)
+        self.assertEqual(index.page_ids, [page_id for page_id, _ in self.pages])
+        np.testing.assert_array_equal(index.matrix, expected.matrix)
+        np.testing.assert_array_equal(index.page_offsets, expected.page_offsets)
+
+    def test_shard_takes_the_dimensions_of_its_rows(self):
+        write_shard('org', self.pages, dim=768)
+        self.assertEqual(open_shard('org')[0].matrix.shape, (10, 8))
+
+        # an empty shard is written again rather than appended to
+        write_shard('org', [], dim=768)
+        self.assertFalse(append_to_shard('org', self.pages))
+
+    def test_rebuild_replaces_shard(self):
+        write_shard('org', self.pages, dim=8)
+        write_shard('org', self.pages[:1], dim=8)
+        self.assertEqual(open_shard('org')[0].page_ids, [self.pages[0][0]])
+
+    @override_settings(RAG_USE_SHARDS=True, RAG_INDEX_QUANTIZATION=None, RAG_ANN_MIN_CORPUS=4, RAG_ANN_NLIST=2)
+    def test_ann_is_trained_by_the_shard_tasks(self):
+        write_shard('org', self.pages, dim=8)
+        train_shard_ann('org')
+        self.assertEqual(open_shard('org')[0].ann.row_count, 10)
+
+        # query processes load the stored index instead of training one
+        with mock.patch('rag.utils.indexCache.IVFIndex.train') as train:
+            index, _ = build_organization_index('org')
+        train.assert_not_called()
+        self.assertEqual(index.ann.row_count, 10)
+
+
+class FederatedSearchTests(SimpleTestCase):
+    def test_merges_organizations_on_similarity(self):
+        org_results = {
+            'org-a': [{'rag_page_id': 'a1', 'similarity_score': 0.9}, {'rag_page_id': 'a2', 'similarity_score': 0.4}],
+            'org-b': [{'rag_page_id': 'b1', 'similarity_score': 0.7}, {'rag_page_id': 'b2', 'similarity_score': 0.1}],
+        }
+
+        def search(queries, organization_id, top_k, queries_embeddings, hybrid):
+            # fused rankings are not comparable across organizations
+            self.assertFalse(hybrid)
+            return [[dict(result) for result in org_results[organization_id]]]
+
+        with mock.patch('rag.utils.searchUtil.get_query_embeddings', return_value=np.ones((1, 2))) as embed, \
+                mock.patch('rag.utils.searchUtil.search_organization_batch', side_effect=search):
+            results = search_organizations("query", ['org-a', 'org-b'], top_k=3)
+
+        self.assertEqual(embed.call_count, 1)
+        self.assertEqual([(r['organization_id'], r['rag_page_id']) for r in results],
+                         [('org-a', 'a1'), ('org-b', 'b1'), ('org-a', 'a2')])
+
+
+@override_settings(CACHES=LOCMEM_CACHES, RAG_SUMMARY_CONCURRENCY=4, RAG_SUMMARY_GLOBAL_CONCURRENCY=2,
+                   RAG_RENDER_WINDOW=3, RAG_TEXT_LAYER_MIN_CHARS=10)
+class SummarizationTests(SimpleTestCase):
+    def summarize(self, page_texts, find_page=None):
+        def texts(path, first_page, last_page):
+            return page_texts[first_page - 1:last_page]
+
+        def render(path, first_page, last_page):
+            return [f"page-{page}" for page in range(first_page, last_page + 1)]
+
+        with mock.patch('rag.utils.ragUtil.pdfinfo_from_path', return_value={'Pages': len(page_texts)}), \
+                mock.patch('rag.utils.ragUtil.pdf_page_texts', side_effect=texts), \
+                mock.patch('rag.utils.ragUtil.render_pages', side_effect=render) as convert, \
+                mock.patch('rag.utils.ragUtil.encode_image', side_effect=lambda img: img), \
+                mock.patch('rag.utils.ragUtil.summarize_text', side_effect=lambda text: f"summary of {text}"), \
+                mock.patch('rag.utils.ragUtil.summarize_text_with_image',
+                           side_effect=lambda text, image, **kwargs: f"summary of {image}"):
+            return pdf_to_summaries_per_page("file.pdf", find_page), convert
+
+    def test_pages_rendered_in_windows_and_summarized_in_order(self):
+        summaries, convert = self.summarize([''] * 20)
+
+        self.assertEqual([page.summary for page in summaries],
+                         [f"summary of page-{page}" for page in range(1, 21)])
+        self.assertEqual(convert.call_count, 7)
+
+    def test_text_rich_pages_skip_the_vision_model(self):
+        page_texts = ['', 'a page with plenty of text', '', '', 'more text on this page']
+        summaries, convert = self.summarize(page_texts)
+
+        self.assertEqual([(page.summary, page.source) for page in summaries], [
+            ("summary of page-1", 'image'),
+            ("summary of a page with plenty of text", 'text'),
+            ("summary of page-3", 'image'),
+            ("summary of page-4", 'image'),
+            ("summary of more text on this page", 'text'),
+        ])
+        # text pages are never rendered, pages 3 and 4 are in different windows
+        self.assertEqual([c.args[1] for c in convert.call_args_list], [1, 3, 4])
+
+    def test_identical_pages_reuse_summaries(self):
+        page_texts = ['a page with plenty of text', '', 'another page of text']
+        known = {page_hash('text', page_texts[0]): PageSummary("known summary", 'text', 'hash', b'embeddings'),
+                 page_hash('image', 'page-2'): PageSummary("known image summary", 'image', 'hash', b'embeddings')}
+        summaries, _ = self.summarize(page_texts, find_page=known.get)
+
+        self.assertEqual([page.summary for page in summaries],
+                         ["known summary", "known image summary", "summary of another page of text"])
+        self.assertEqual(summaries[2].content_hash, page_hash('text', page_texts[2]))
+        self.assertIsNone(summaries[2].embeddings)
+
+
+class EmbeddingBatchTests(SimpleTestCase):
+    def test_chunks_of_all_texts_share_requests(self):
+        def create(model, input):
+            return mock.Mock(data=[mock.Mock(embedding=[float(len(chunk))]) for chunk in input])
+
+        texts = ["one", "two words", "", "three more words"]
+        with mock.patch('rag.utils.llmUtil.together_client') as client, \
+                mock.patch('rag.utils.llmUtil.embedding_max_tokens', 2), \
+                mock.patch('rag.utils.llmUtil.embedding_batch_size', 3):
+            client.embeddings.create.side_effect = create
+            embeddings = generate_embeddings_batch(texts)
+
+        # 4 chunks: "one", "two words", "three more ", "words"
+        self.assertEqual(client.embeddings.create.call_count, 2)
+        self.assertEqual(embeddings, [[[3.0]], [[9.0]], [], [[11.0], [5.0]]])
+
+
+@override_settings(CACHES=LOCMEM_CACHES, RAG_USE_SHARDS=False)
+class AsyncQueryViewTests(TestCase):
+    url = '/rag/query/async/'
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("owner@example.com", "Query-Test-2046", "Owner", "User")
+        self.organization = Organization.objects.create_organization("Org", self.user)
+        fileInstance = FileModel.objects.create(
+            name="a.pdf", directory=self.organization.root_directory, file_type='pdf',
+            created_by=self.user, organization=self.organization, file="a.pdf")
+        rag_file_profile = RAGFileProfile(file=fileInstance, organization=self.organization,
+                                          page_count=1, status='complete')
+        rag_file_profile.save()
+        self.page = RAGPage(rag_file_profile=rag_file_profile, page_number=0, summary="valve",
+                            embeddings=encode_embeddings([[1.0, 0.0]], normalize=True))
+        self.page.save()
+
+    def headers(self, user=None) -> dict:
+        return {'Authorization': f"Bearer {AccessToken.for_user(user or self.user)}"}
+
+    def body(self, query="valve") -> str:
+        return json.dumps({'query': query, 'organization_id': str(self.organization.id)})
+
+    async def test_requires_credentials(self):
+        response = await self.async_client.post(self.url, self.body(), content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+
+    async def test_rejects_invalid_requests(self):
+        response = await self.async_client.post(self.url, "{not json", content_type='application/json',
+                                                 headers=self.headers())
+        self.assertEqual(response.status_code, 400)
+
+        response = await self.async_client.post(self.url, self.body(query=" "), content_type='application/json',
+                                                 headers=self.headers())
+        self.assertEqual(response.status_code, 400)
+
+    async def test_requires_access_to_the_organization(self):
+        other = await sync_to_async(User.objects.create_user)("other@example.com", "Query-Test-2046", "Other", "User")
+        response = await self.async_client.post(self.url, self.body(), content_type='application/json',
+                                                headers=await sync_to_async(self.headers)(other))
+        self.assertEqual(response.status_code, 403)
+
+    async def test_cached_results_skip_embedding(self):
+        key, _ = await sync_to_async(get_query_results)(str(self.organization.id), "valve", QUERY_TOP_K)
+        await sync_to_async(set_query_results)(key, [{'rag_page_id': 'cached'}])
+
+        with mock.patch('rag.views.aget_query_embeddings_batch', new=mock.AsyncMock()) as embed:
+            response = await self.async_client.post(self.url, self.body(), content_type='application/json',
+                                                    headers=self.headers())
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), [{'rag_page_id': 'cached'}])
+        embed.assert_not_called()
+
+    async def test_results_get_page_details_and_are_cached(self):
+        with mock.patch('rag.views.aget_query_embeddings_batch',
+                        new=mock.AsyncMock(return_value=[np.array([[1.0, 0.0]])])), \
+                mock.patch('rag.views.search_organization_batch',
+                           return_value=[[{'rag_page_id': self.page.id, 'similarity_score': 1.0}]]) as search:
+            response = await self.async_client.post(self.url, self.body(), content_type='application/json',
+                                                    headers=self.headers())
+
+        self.assertEqual(response.status_code, 200)
+        result = response.json()[0]
+        self.assertEqual((result['rag_page_id'], result['file_name'], result['file_page']),
+                         (str(self.page.id), "a.pdf", 0))
+        self.assertEqual(search.call_args.kwargs['queries_embeddings'][0].tolist(), [[1.0, 0.0]])
+
+        _, cached = await sync_to_async(get_query_results)(str(self.organization.id), "valve", QUERY_TOP_K)
+        self.assertEqual(len(cached), 1)
+
+
+class LLMResponseCacheTests(TestCase):
+    def test_stored_response_skips_the_llm(self):
+        create = mock.Mock(return_value="summary")
+        self.assertEqual(cached_response('model', ["text"], create), "summary")
+        self.assertEqual(cached_response('model', ["text"], create), "summary")
+        self.assertEqual(create.call_count, 1)
+
+        cached_response('model', ["other text"], create)
+        cached_response('other-model', ["text"], create)
+        self.assertEqual(create.call_count, 3)
+
+    def test_cache_can_be_bypassed(self):
+        create = mock.Mock(return_value="summary")
+        cached_response('model', ["text"], create)
+
+        cached_response('model', ["text"], create, use_cache=False)
+        with override_settings(RAG_LLM_CACHE_ENABLED=False):
+            cached_response('model', ["other text"], create)
+            cached_response('model', ["other text"], create)
+
+        self.assertEqual(create.call_count, 4)
+        self.assertEqual(LLMResponse.objects.count(), 1)
+
+    def test_evicts_least_recently_used(self):
+        now = timezone.now()
+        for hours_ago, key in [(1, 'new'), (3, 'old'), (2, 'middle')]:
+            LLMResponse.objects.create(key=key, model='model', response="x" * 10, size=10)
+            LLMResponse.objects.filter(key=key).update(last_used_at=now - timedelta(hours=hours_ago))
+
+        self.assertEqual(evict_llm_responses(max_bytes=15), 2)
+        self.assertEqual(list(LLMResponse.objects.values_list('key', flat=True)), ['new'])
+        self.assertEqual(evict_llm_responses(max_bytes=15), 0)
+
+
+def page_summaries(fileInstance, find_page, first_page, last_page):
+    return [PageSummary(f"valve page {page}", 'text') for page in range(first_page, last_page + 1)]
+
+
+def summary_embeddings(summaries):
+    return [[[1.0, float(i)]] for i in range(len(summaries))]
+
+
+@override_settings(CACHES=LOCMEM_CACHES, RAG_USE_SHARDS=False)
+@mock.patch('rag.models.summaries_to_embeddings', side_effect=summary_embeddings)
+@mock.patch('rag.models.file_to_summaries', side_effect=page_summaries)
+@mock.patch('rag.models.file_page_count', return_value=3)
+class RAGIngestionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("owner@example.com", "Ingest-Test-2046", "Owner", "User")
+        self.organization = Organization.objects.create_organization("Org", self.user)
+        self.directory = self.organization.root_directory.add_child(
+            name="Reports", organization=self.organization, created_by=self.user)
+
+    def file(self, name, directory=None):
+        return FileModel.objects.create(
+            name=name, directory=directory or self.organization.root_directory, file_type='pdf',
+            created_by=self.user, organization=self.organization, file=name)
+
+    def test_windows_bulk_insert_pages_and_the_last_completes_the_profile(self, *mocks):
+        rag_file_profile = RAGFileProfile.objects.start(self.file("a.pdf"), self.organization)
+
+        self.assertFalse(RAGFileProfile.objects.ingest_pages(rag_file_profile, 1, 2))
+        self.assertEqual(rag_file_profile.progress(), {'status': 'processing', 'pages_done': 2, 'page_count': 3})
+        self.assertEqual(RAGPagePosting.objects.filter(term='valve').count(), 2)
+
+        self.assertTrue(RAGFileProfile.objects.ingest_pages(rag_file_profile, 3, 3))
+        self.assertEqual(RAGFileProfile.objects.get(id=rag_file_profile.id).status, 'complete')
+        self.assertEqual(list(rag_file_profile.rag_pages.values_list('page_number', flat=True)), [0, 1, 2])
+
+        # a retry of a window already stored changes nothing
+        self.assertFalse(RAGFileProfile.objects.ingest_pages(rag_file_profile, 1, 2))
+        self.assertEqual(rag_file_profile.rag_pages.count(), 3)
+
+    def test_pages_stored_by_a_concurrent_attempt_are_skipped(self, file_page_count, file_to_summaries,
+                                                             summaries_to_embeddings):
+        rag_file_profile = RAGFileProfile.objects.start(self.file("a.pdf"), self.organization)
+
+        def embed_while_another_attempt_stores_a_page(summaries):
+            RAGPage.objects.create(rag_file_profile=rag_file_profile, page_number=0, summary="valve page 1",
+                                   embeddings=encode_embeddings([[1.0, 0.0]], normalize=True))
+            return summary_embeddings(summaries)
+        summaries_to_embeddings.side_effect = embed_while_another_attempt_stores_a_page
+
+        self.assertTrue(RAGFileProfile.objects.ingest_pages(rag_file_profile, 1, 3))
+        self.assertEqual(list(rag_file_profile.rag_pages.values_list('page_number', flat=True)), [0, 1, 2])
+        self.assertEqual(RAGPagePosting.objects.filter(rag_page__page_number=0).count(), 0)
+
+    def test_pages_of_incomplete_profiles_are_hidden(self, *mocks):
+        processing = RAGFileProfile.objects.start(self.file("b.pdf", self.directory), self.organization)
+        RAGFileProfile.objects.ingest_pages(processing, 1, 2)
+        hidden = set(processing.rag_pages.values_list('id', flat=True))
+
+        _, error = query_scope(self.user, self.organization.id, None)
+        self.assertEqual(error.status_code, 404)
+
+        complete = RAGFileProfile.objects.start(self.file("a.pdf", self.directory), self.organization)
+        RAGFileProfile.objects.ingest_pages(complete, 1, 3)
+        visible = set(complete.rag_pages.values_list('id', flat=True))
+
+        self.assertEqual(query_scope(self.user, self.organization.id, None), (None, None))
+        self.assertEqual({page_id for page_id, _ in load_organization_pages(self.organization.id)}, visible)
+        self.assertEqual({page_id for page_id, _ in bm25_search(self.organization.id, "valve", 10)}, visible)
+        self.assertEqual(set(directory_page_ids(self.directory)), visible)
+
+        results = [{'rag_page_id': page_id} for page_id in visible | hidden]
+        add_page_details(results)
+        self.assertEqual({result['rag_page_id'] for result in results}, visible)
+
+    def test_deleting_a_profile_bumps_the_generation_once(self, *mocks):
+        rag_file_profile = RAGFileProfile.objects.start(self.file("a.pdf"), self.organization)
+        RAGFileProfile.objects.ingest_pages(rag_file_profile, 1, 3)
+
+        with mock.patch('rag.signals.bump_generation') as bump:
+            rag_file_profile.delete()
+        bump.assert_called_once_with(str(self.organization.id))
+        self.assertFalse(RAGPage.objects.exists())
+
+    def test_backfill_completes_profiles_ingested_in_one_go(self, *mocks):
+        legacy = RAGFileProfile.objects.start(self.file("a.pdf"), self.organization)
+        RAGFileProfile.objects.ingest_pages(legacy, 1, 2)
+        RAGFileProfile.objects.filter(id=legacy.id).update(page_count=0)
+        processing = RAGFileProfile.objects.start(self.file("b.pdf"), self.organization)
+        RAGFileProfile.objects.ingest_pages(processing, 1, 1)
+
+        call_command('backfill_rag_file_profiles', stdout=io.StringIO())
+
+        legacy.refresh_from_db()
+        self.assertEqual(legacy.progress(), {'status': 'complete', 'pages_done': 2, 'page_count': 2})
+        self.assertEqual(RAGFileProfile.objects.get(id=processing.id).status, 'processing')
+
+    def test_create_publishes_the_pages(self, *mocks):
+        shard_root = tempfile.TemporaryDirectory()
+        self.addCleanup(shard_root.cleanup)
+        generation = bump_generation(self.organization.id)
+
+        with override_settings(RAG_USE_SHARDS=True, RAG_SHARD_ROOT=shard_root.name):
+            with self.captureOnCommitCallbacks(execute=True):
+                rag_file_profile = RAGFileProfile.objects.create(self.file("a.pdf"), self.organization)
+
+            self.assertEqual(set(open_shard(self.organization.id)[0].page_ids),
+                             set(rag_file_profile.rag_pages.values_list('id', flat=True)))
+        self.assertGreater(get_generation(self.organization.id), generation)
+
+
+@override_settings(RAG_INGEST_WINDOW=4, RAG_BULK_QUEUE='bulk', RAG_PRIORITY_QUEUE='priority',
+                   RAG_PRIORITY_MAX_BYTES=1000, RAG_PRIORITY_MAX_PAGES=20)
+class IngestionDispatchTests(SimpleTestCase):
+    def test_only_windows_with_missing_pages_are_queued(self):
+        rag_file_profile = mock.Mock(id='profile', page_count=10)
+        with mock.patch('rag.tasks.RAGFileProfile.objects.missing_pages', return_value=[2, 3, 10]), \
+                mock.patch('rag.tasks.ingest_rag_file_window.apply_async') as apply_async:
+            dispatch_rag_file_profile(rag_file_profile, 'priority')
+
+        self.assertEqual([c.args[0] for c in apply_async.call_args_list],
+                         [('profile', 1, 4, 'priority'), ('profile', 9, 10, 'priority')])
+        self.assertEqual({c.kwargs['queue'] for c in apply_async.call_args_list}, {'priority'})
+
+    def test_large_files_go_on_the_bulk_queue(self):
+        with mock.patch('rag.tasks.file_page_count', return_value=5):
+            self.assertEqual(ingestion_queue(mock.Mock(file_size=500)), 'priority')
+            self.assertEqual(ingestion_queue(mock.Mock(file_size=5000)), 'bulk')
+        with mock.patch('rag.tasks.file_page_count', return_value=50):
+            self.assertEqual(ingestion_queue(mock.Mock(file_size=500)), 'bulk')
+
+
+@override_settings(CACHES=LOCMEM_CACHES, RAG_INGEST_ORG_CONCURRENCY=1, RAG_INGEST_SLOT_TIMEOUT=60,
+                   RAG_INGEST_DEFER_SECONDS=5)
+class IngestionFairnessTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_windows_over_the_organization_cap_are_requeued(self):
+        rag_file_profile = mock.Mock(id='profile', organization_id='org')
+        slot = acquire_slot("ingest:org", 1)
+        with mock.patch('rag.tasks.RAGFileProfile.objects.filter') as filter, \
+                mock.patch('rag.tasks.RAGFileProfile.objects.ingest_pages') as ingest_pages, \
+                mock.patch('rag.tasks.ingest_rag_file_window.apply_async') as apply_async:
+            filter.return_value.first.return_value = rag_file_profile
+            ingest_pages.return_value = False
+
+            ingest_rag_file_window('profile', 1, 4, 'bulk')
+            ingest_pages.assert_not_called()
+            apply_async.assert_called_once_with(('profile', 1, 4, 'bulk'), queue='bulk', countdown=5)
+
+            release_slot(slot)
+            ingest_rag_file_window('profile', 1, 4, 'bulk')
+            ingest_pages.assert_called_once_with(rag_file_profile, 1, 4)
+
+        # the slot is released after the window
+        self.assertIsNotNone(acquire_slot("ingest:org", 1))
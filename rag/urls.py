@@ -1,6 +1,10 @@
 from django.urls import path
-from .views import post_query
+from .views import get_file_progress, post_query, post_query_async, post_query_batch, post_query_federated
 
 urlpatterns = [
     path('query/', post_query),
+    path('query/batch/', post_query_batch),
+    path('query/async/', post_query_async),
+    path('query/federated/', post_query_federated),
+    path('files/<str:file_id>/progress/', get_file_progress),
 ]
@@ -0,0 +1,112 @@
+import numpy as np
+
+from rag.utils.benchmarkUtil import overlap_at_k
+from rag.utils.indexUtil import EmbeddingIndex, normalize_rows, query_vector
+
+
+def kmeans(matrix: np.ndarray, nlist: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    '''
+    Spherical k-means over normalized rows, returning nlist normalized
+    centroids. Empty clusters are re-seeded from random rows.
+    '''
+    rng = np.random.default_rng(seed)
+    centroids = matrix[rng.choice(
+        matrix.shape[0], nlist, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = np.argmax(matrix @ centroids.T, axis=1)
+
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, matrix)
+        empty = np.bincount(assignments, minlength=nlist) == 0
+        sums[empty] = matrix[rng.choice(matrix.shape[0], empty.sum())]
+
+        centroids = normalize_rows(sums)
+
+    return centroids
+
+
+class IVFIndex:
+    '''
+    Inverted file index over the rows of an EmbeddingIndex matrix.
+
+    Rows are clustered around nlist coarse centroids, and a query only scans
+    the rows of the nprobe clusters closest to it. Rows appended to the
+    matrix after training (row >= row_count) are not in any list and are
+    always scanned exactly, so the index stays valid as pages are added.
+    '''
+
+    def __init__(self, centroids: np.ndarray, list_offsets: np.ndarray, list_rows: np.ndarray, row_count: int):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_rows = list_rows
+        self.row_count = row_count
+
+    @classmethod
+    def train(cls, matrix: np.ndarray, nlist: int = None, sample_size: int = 256) -> 'IVFIndex':
+        '''
+        Train the coarse centroids on at most sample_size rows per list, then
+        assign every row of the matrix to its closest centroid
+        '''
+        row_count = matrix.shape[0]
+        nlist = min(nlist or int(np.sqrt(row_count)), row_count)
+
+        rng = np.random.default_rng(0)
+        if row_count > nlist * sample_size:
+            sample = matrix[rng.choice(
+                row_count, nlist * sample_size, replace=False)]
+        else:
+            sample = matrix
+        centroids = kmeans(sample, nlist)
+
+        assignments = np.empty(row_count, dtype=np.intp)
+        # assign in blocks to bound the size of the rows x centroids product
+        for start in range(0, row_count, 65536):
+            block = matrix[start:start + 65536]
+            assignments[start:start + 65536] = np.argmax(
+                block @ centroids.T, axis=1)
+
+        list_rows = np.argsort(assignments, kind='stable')
+        list_offsets = np.searchsorted(
+            assignments[list_rows], np.arange(nlist + 1))
+
+        return cls(centroids, list_offsets, list_rows, row_count)
+
+    def scanned_rows(self, nprobe: int) -> int:
+        '''
+        The number of trained rows a query probing nprobe lists scans on average
+        '''
+        return self.row_count * min(nprobe, len(self.centroids)) // len(self.centroids)
+
+    def candidate_rows(self, query: np.ndarray, matrix_rows: int, nprobe: int) -> np.ndarray:
+        nprobe = min(nprobe, len(self.centroids))
+        probes = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+
+        rows = [self.list_rows[self.list_offsets[p]:self.list_offsets[p + 1]]
+                for p in probes]
+        rows.append(np.arange(self.row_count, matrix_rows))
+        return np.concatenate(rows)
+
+    def page_scores(self, index: EmbeddingIndex, query_embeddings: list[list[float]], nprobe: int,
+                    page_mask: np.ndarray = None) -> np.ndarray:
+        '''
+        Approximate EmbeddingIndex.page_scores, scoring only the candidate
+        rows. Pages without a candidate row score -inf.
+        '''
+        query = query_vector(query_embeddings)
+        rows = self.candidate_rows(query, index.row_count, nprobe)
+        if page_mask is not None:
+            rows = rows[page_mask[index.row_pages[rows]]]
+
+        return index.scatter_page_scores(rows, index.matrix[rows] @ query)
+
+
+def recall_at_k(index: EmbeddingIndex, queries: list, top_k: int = 5, nprobe: int = 8) -> float:
+    '''
+    Fraction of the exact top_k pages that the ANN index also returns,
+    averaged over queries, each query being a list of chunk embeddings
+    '''
+    return overlap_at_k(
+        [index.search(query, top_k, exact=True) for query in queries],
+        [index.search(query, top_k, nprobe=nprobe) for query in queries]
+    )
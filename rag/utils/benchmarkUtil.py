@@ -0,0 +1,41 @@
+import time
+
+import numpy as np
+
+from rag.utils.indexUtil import EmbeddingIndex
+
+
+def sample_queries(index: EmbeddingIndex, count: int, noise: float = 0.02, seed: int = 0) -> list:
+    '''
+    Perturbed copies of stored embeddings, standing in for real queries so
+    benchmarks need no embedding API calls
+    '''
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(index.row_count, min(count, index.row_count), replace=False)
+    queries = index.matrix[rows] + \
+        rng.normal(scale=noise, size=(len(rows), index.matrix.shape[1]))
+    return [[query] for query in queries]
+
+
+def time_queries(search, queries: list) -> float:
+    '''
+    Average milliseconds search takes per query
+    '''
+    start = time.perf_counter()
+    for query in queries:
+        search(query)
+    return (time.perf_counter() - start) * 1000 / len(queries)
+
+
+def overlap_at_k(expected: list[list[dict]], actual: list[list[dict]]) -> float:
+    '''
+    Fraction of the expected result pages that also appear in the actual
+    results, over a list of queries
+    '''
+    hits = 0
+    total = 0
+    for expected_results, actual_results in zip(expected, actual):
+        expected_ids = {r['rag_page_id'] for r in expected_results}
+        hits += len(expected_ids & {r['rag_page_id'] for r in actual_results})
+        total += len(expected_ids)
+    return hits / total if total else 1.0
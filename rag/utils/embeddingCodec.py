@@ -0,0 +1,111 @@
+'''
+Binary storage format of RAGPage.embeddings
+
+    magic     4 bytes   b'RAGE'
+    version   uint8
+    dtype     uint8     index into DTYPES
+    flags     uint16    bit field of FLAG_* values
+    dim       uint32    dimensions of each embedding
+    count     uint32    number of embeddings
+    model_len uint8     length of the utf-8 embedding model name
+    model     model_len bytes
+    data      count * dim little-endian floats of the given dtype
+
+Rows written before this format existed hold the old JSON text instead,
+which decode_embeddings still reads.
+'''
+
+import json
+import struct
+from typing import NamedTuple
+
+import numpy as np
+
+from rag.utils.indexUtil import normalize_rows
+
+MAGIC = b'RAGE'
+VERSION = 1
+DTYPES = ['<f4', '<f2']
+HEADER = struct.Struct('<4sBBHIIB')
+
+# every embedding was L2-normalized before being stored
+FLAG_NORMALIZED = 0x1
+
+
+class EmbeddingHeader(NamedTuple):
+    dtype: str
+    flags: int
+    dim: int
+    count: int
+    model: str
+    data_offset: int
+
+
+def encode_embeddings(embeddings, model: str = '', dtype: str = 'float32', normalize: bool = False) -> bytes:
+    matrix = np.array(embeddings, dtype=np.float32, ndmin=2)
+    if matrix.size == 0:
+        matrix = matrix.reshape(0, 0)
+
+    flags = 0
+    if normalize:
+        normalize_rows(matrix)
+        flags |= FLAG_NORMALIZED
+
+    matrix = matrix.astype(np.dtype(dtype).newbyteorder('<'))
+    model_bytes = model.encode('utf-8')
+
+    return HEADER.pack(
+        MAGIC,
+        VERSION,
+        DTYPES.index(matrix.dtype.str),
+        flags,
+        matrix.shape[1],
+        matrix.shape[0],
+        len(model_bytes),
+    ) + model_bytes + matrix.tobytes()
+
+
+def is_encoded(value) -> bool:
+    return isinstance(value, (bytes, bytearray, memoryview)) and bytes(value[:4]) == MAGIC
+
+
+def read_header(value) -> EmbeddingHeader:
+    magic, version, dtype, flags, dim, count, model_len = HEADER.unpack_from(value)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not an encoded embedding matrix")
+
+    model_start = HEADER.size
+    model = bytes(value[model_start:model_start + model_len]).decode('utf-8')
+    return EmbeddingHeader(DTYPES[dtype], flags, dim, count, model, model_start + model_len)
+
+
+def decode_embeddings(value) -> np.ndarray:
+    '''
+    Load stored embeddings as a float32 (count, dim) numpy array.
+
+    float32 data is returned as a read-only view on the stored bytes, so no
+    per-float Python objects are ever created.
+    '''
+    if not is_encoded(value):
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            value = bytes(value).decode('utf-8')
+        return np.array(json.loads(value), dtype=np.float32, ndmin=2)
+
+    header = read_header(value)
+    matrix = np.frombuffer(value, dtype=header.dtype, count=header.count * header.dim,
+                           offset=header.data_offset).reshape(header.count, header.dim)
+    return matrix.astype(np.float32, copy=False)
+
+
+def is_normalized(value) -> bool:
+    return is_encoded(value) and bool(read_header(value).flags & FLAG_NORMALIZED)
+
+
+def decode_normalized_embeddings(value) -> np.ndarray:
+    '''
+    Like decode_embeddings, but with every row L2-normalized. Rows stored
+    normalized are returned as is, without any arithmetic.
+    '''
+    if is_normalized(value):
+        return decode_embeddings(value)
+    return normalize_rows(decode_embeddings(value).copy())
@@ -0,0 +1,263 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+
+from rag.utils.annUtil import IVFIndex
+from rag.utils.embeddingCodec import decode_normalized_embeddings
+from rag.utils.indexUtil import EmbeddingIndex
+from rag.utils.quantizeUtil import QuantizedIndex
+from rag.utils.llmUtil import embedding_dimensions
+from rag.utils.shardUtil import append_to_shard, current_shard_dir, extend_shard, open_shard, shard_lock, write_ann, write_shard
+
+
+def generation_key(organization_id) -> str:
+    return f"rag:index-generation:{organization_id}"
+
+
+def get_generation(organization_id) -> int:
+    '''
+    The generation of an organization's RAG store, shared by every process
+    through Django's cache. It changes whenever a RAG page is added, changed
+    or removed, so a cached index built at an older generation is stale.
+    '''
+    key = generation_key(organization_id)
+    # start from the current time so a counter evicted from the cache can never
+    # come back at a value some process already cached an index for
+    cache.add(key, int(time.time() * 1000), timeout=None)
+    return cache.get(key)
+
+
+def bump_generation(organization_id) -> int:
+    get_generation(organization_id)
+    try:
+        return cache.incr(generation_key(organization_id))
+    except ValueError:
+        # the key was evicted between the add and the incr
+        return get_generation(organization_id)
+
+
+def load_page_embeddings(page_ids: list) -> list:
+    '''
+    The normalized embeddings of the given pages, as (page_id, embeddings) pairs
+    '''
+    RAGPage = apps.get_model('rag', 'RAGPage')
+    pages = RAGPage.objects.filter(id__in=page_ids).order_by().values_list('id', 'embeddings')
+    return [(page_id, decode_normalized_embeddings(embeddings)) for page_id, embeddings in pages]
+
+
+def load_organization_pages(organization_id):
+    '''
+    The normalized embeddings of every page of the completely ingested files
+    of an organization, as (page_id, embeddings) pairs read from the database
+    '''
+    RAGPage = apps.get_model('rag', 'RAGPage')
+    pages = RAGPage.objects.filter(
+        rag_file_profile__organization_id=organization_id,
+        rag_file_profile__status='complete').values_list('id', 'embeddings')
+    for page_id, embeddings in pages.iterator():
+        yield page_id, decode_normalized_embeddings(embeddings)
+
+
+def write_organization_shard(organization_id):
+    # callers must hold the shard_lock of the organization
+    write_shard(organization_id, load_organization_pages(
+        organization_id), embedding_dimensions)
+
+
+def append_profile_to_shard(rag_file_profile):
+    '''
+    Add the pages of a newly ingested RAG file profile to its organization's
+    shard, writing the whole shard if the organization has none yet
+    '''
+    if not settings.RAG_USE_SHARDS:
+        return
+
+    organization_id = rag_file_profile.organization_id
+    pages = ((page.id, decode_normalized_embeddings(page.embeddings))
+             for page in rag_file_profile.rag_pages.only('id', 'embeddings'))
+
+    with shard_lock(organization_id):
+        if not append_to_shard(organization_id, pages):
+            write_organization_shard(organization_id)
+    train_shard_ann(organization_id)
+
+
+def build_organization_index(organization_id) -> tuple:
+    '''
+    Build the index of an organization, returned with the shard it was read
+    from as (index, (shard index, ShardState)), or (index, None) when it was
+    read from the database
+    '''
+    # prefer the memory mapped shard, shared with every other worker process,
+    # whose IVF index is trained by the shard tasks (see train_shard_ann)
+    opened = open_shard(organization_id) if settings.RAG_USE_SHARDS else None
+    if opened is not None:
+        index = opened[0]
+        if settings.RAG_INDEX_QUANTIZATION:
+            return QuantizedIndex.from_index(index, settings.RAG_INDEX_QUANTIZATION, index.page_embeddings,
+                                             settings.RAG_QUANTIZED_RESCORE_CANDIDATES), opened
+        return index, opened
+
+    index = EmbeddingIndex.from_pages(
+        load_organization_pages(organization_id), normalized=True)
+
+    # keep only compact codes in memory, rescoring from the database
+    if settings.RAG_INDEX_QUANTIZATION:
+        return QuantizedIndex.from_index(index, settings.RAG_INDEX_QUANTIZATION, load_page_embeddings,
+                                         settings.RAG_QUANTIZED_RESCORE_CANDIDATES), None
+
+    # large organizations are searched through an approximate index
+    if index.row_count >= settings.RAG_ANN_MIN_CORPUS:
+        index = index.with_ann(IVFIndex.train(
+            index.matrix, settings.RAG_ANN_NLIST))
+    return index, None
+
+
+def extend_organization_index(index: EmbeddingIndex, shard: tuple) -> tuple:
+    '''
+    Patch an index built from a shard with the pages appended to the shard
+    since it was built, keeping its ann index or quantized codes. Returns the
+    same tuple as build_organization_index, or None when the shard was
+    rebuilt or retrained and the index must be built again.
+    '''
+    extended = extend_shard(*shard)
+    if extended is None:
+        return None
+
+    shard_index = extended[0]
+    if isinstance(index, QuantizedIndex):
+        return index.extended(shard_index, shard_index.page_embeddings), extended
+    return shard_index, extended
+
+
+def needs_rebuild(index: EmbeddingIndex) -> bool:
+    '''
+    Whether an index grown by appended pages should be rebuilt from scratch,
+    either to gain an ann index or because too many rows sit outside of it
+    '''
+    if isinstance(index, QuantizedIndex):
+        return False
+    if index.ann is None:
+        return index.row_count >= settings.RAG_ANN_MIN_CORPUS
+    return index.row_count - index.ann.row_count > settings.RAG_ANN_REBUILD_FRACTION * index.ann.row_count
+
+
+def train_shard_ann(organization_id):
+    '''
+    Train the IVF index of an organization's shard once the shard reaches
+    RAG_ANN_MIN_CORPUS rows, or RAG_ANN_REBUILD_FRACTION more rows than the
+    index covers, and store it next to the shard for the query processes.
+    Called by the shard tasks after writing, training takes seconds on large
+    organizations.
+    '''
+    opened = open_shard(organization_id)
+    if opened is None or not needs_rebuild(opened[0]):
+        return
+
+    index, state = opened
+    ann = IVFIndex.train(index.matrix, settings.RAG_ANN_NLIST)
+    with shard_lock(organization_id):
+        # a rebuild that replaced the build meanwhile trains its own index
+        if current_shard_dir(organization_id) == state.shard_dir:
+            write_ann(state.shard_dir, ann)
+
+
+class IndexCache:
+    '''
+    Process-local LRU cache of organization embedding indexes, bounded by the
+    total size of the cached matrices
+    '''
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        # organization_id -> (generation, index, shard the index was read from)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # organization_id -> lock held while building its index
+        self._build_locks = {}
+
+    def get(self, organization_id) -> EmbeddingIndex:
+        generation = get_generation(organization_id)
+
+        with self._lock:
+            entry = self._entries.get(organization_id)
+            if entry is not None and entry[0] == generation:
+                self._entries.move_to_end(organization_id)
+                return entry[1]
+
+            build_lock = self._build_locks.setdefault(organization_id, threading.Lock())
+
+        # concurrent queries of an organization wait for a single build
+        with build_lock:
+            with self._lock:
+                entry = self._entries.get(organization_id)
+                if entry is not None and entry[0] == generation:
+                    self._entries.move_to_end(organization_id)
+                    return entry[1]
+
+            # pages are appended to shards by the ingestion workers, an index
+            # read from a shard only needs the pages appended since
+            built = None
+            if entry is not None and entry[2] is not None:
+                built = extend_organization_index(entry[1], entry[2])
+            if built is None:
+                built = build_organization_index(organization_id)
+            self._store(organization_id, generation, *built)
+            return built[0]
+
+    def add_page(self, organization_id, generation: int, page_id, embeddings):
+        '''
+        Patch a cached index with a newly created page, if the cached index
+        was current right before the page was added (generation - 1).
+        Otherwise the entry is dropped and rebuilt on the next query.
+        Indexes read from a shard are left to extend themselves from it.
+
+        embeddings must be L2-normalized, see decode_normalized_embeddings.
+        '''
+        with self._lock:
+            entry = self._entries.get(organization_id)
+            if entry is not None and entry[2] is not None:
+                return
+            self._entries.pop(organization_id, None)
+        if entry is None or entry[0] != generation - 1:
+            return
+
+        index = entry[1]
+        # an index built while the page was being saved may already include it
+        if page_id not in index.page_ids:
+            index = index.with_page(page_id, embeddings, normalized=True)
+        if needs_rebuild(index):
+            return
+        self._store(organization_id, generation, index)
+
+    def invalidate(self, organization_id):
+        with self._lock:
+            self._entries.pop(organization_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _store(self, organization_id, generation: int, index: EmbeddingIndex, shard: tuple = None):
+        if index.nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            self._entries[organization_id] = (generation, index, shard)
+            self._entries.move_to_end(organization_id)
+
+            total = sum(entry[1].nbytes for entry in self._entries.values())
+            while total > self.max_bytes:
+                _, (_, evicted, _) = self._entries.popitem(last=False)
+                total -= evicted.nbytes
+
+
+index_cache = IndexCache(settings.RAG_INDEX_CACHE_MAX_BYTES)
+
+
+def get_organization_index(organization_id) -> EmbeddingIndex:
+    return index_cache.get(str(organization_id))
@@ -0,0 +1,257 @@
+from functools import cached_property
+
+import numpy as np
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    '''
+    L2-normalize every row of a float32 matrix in place and return it.
+    Rows with a norm of zero are left as zeros.
+    '''
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    matrix /= norms
+    return matrix
+
+
+def query_vector(query_embeddings: list[list[float]]) -> np.ndarray:
+    '''
+    Collapse the chunk embeddings of a query into a single scoring vector.
+
+    A page embedding is scored as the sum of its cosine similarity with every
+    query chunk, and sum(q_i . m) == (sum q_i) . m, so the normalized query
+    chunks can be summed once up front.
+    '''
+    query = normalize_rows(np.array(query_embeddings, dtype=np.float32, ndmin=2))
+    return query.sum(axis=0)
+
+
+class EmbeddingIndex:
+    '''
+    All embeddings of a corpus stacked into one contiguous float32 matrix.
+
+    Rows belonging to the same RAG page are stored next to each other, and
+    page_offsets holds the first row of every page, so per-page maxima can be
+    computed with np.maximum.reduceat instead of a Python loop.
+
+    Large corpora can carry an approximate nearest-neighbour index (ann, see
+    rag.utils.annUtil.IVFIndex) that search uses unless exact=True.
+    '''
+
+    def __init__(self, matrix: np.ndarray, page_ids: list, page_offsets: np.ndarray, ann=None):
+        self.matrix = matrix
+        self.page_ids = page_ids
+        self.page_offsets = page_offsets
+        self.ann = ann
+
+    @classmethod
+    def from_pages(cls, pages, normalized: bool = False) -> 'EmbeddingIndex':
+        '''
+        Build an index from an iterable of (rag_page_id, embeddings) pairs,
+        where embeddings is a 2d array or in the format of [[embedding], ...]
+
+        Pass normalized=True when every embedding is already L2-normalized
+        to skip normalizing the matrix.
+        '''
+        page_ids = []
+        page_offsets = []
+        blocks = []
+        row_count = 0
+
+        for page_id, embeddings in pages:
+            block = np.asarray(embeddings, dtype=np.float32)
+            if block.size == 0:
+                continue
+            page_ids.append(page_id)
+            page_offsets.append(row_count)
+            blocks.append(block.reshape(-1, block.shape[-1]))
+            row_count += blocks[-1].shape[0]
+
+        if blocks:
+            matrix = np.vstack(blocks)
+            if not normalized:
+                normalize_rows(matrix)
+        else:
+            matrix = np.zeros((0, 0), dtype=np.float32)
+
+        return cls(matrix, page_ids, np.array(page_offsets, dtype=np.intp))
+
+    @property
+    def page_count(self) -> int:
+        return len(self.page_ids)
+
+    @property
+    def row_count(self) -> int:
+        return self.matrix.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        # page ids are UUIDs, roughly 100 bytes each once boxed in a list
+        nbytes = self.page_offsets.nbytes + 100 * self.page_count
+        # memory mapped shards live in the shared OS page cache, not our heap
+        if not isinstance(self.matrix, np.memmap):
+            nbytes += self.matrix.nbytes
+        if self.ann is not None:
+            # list_rows plus the row_pages mapping the ann search relies on
+            nbytes += self.ann.centroids.nbytes + 2 * self.ann.list_rows.nbytes
+        return nbytes
+
+    @cached_property
+    def row_pages(self) -> np.ndarray:
+        '''
+        The position in page_ids of the page every matrix row belongs to
+        '''
+        rows_per_page = np.diff(np.append(self.page_offsets, self.row_count))
+        return np.repeat(np.arange(self.page_count), rows_per_page)
+
+    @cached_property
+    def page_positions(self) -> dict:
+        return {page_id: i for i, page_id in enumerate(self.page_ids)}
+
+    def page_mask(self, page_ids) -> np.ndarray:
+        '''
+        Boolean mask over page_ids selecting the given pages, ignoring pages
+        not in the index
+        '''
+        mask = np.zeros(self.page_count, dtype=bool)
+        positions = [self.page_positions[page_id]
+                     for page_id in page_ids if page_id in self.page_positions]
+        mask[positions] = True
+        return mask
+
+    def masked_rows(self, page_mask: np.ndarray) -> np.ndarray:
+        '''
+        The rows of the pages selected by page_mask
+        '''
+        return np.flatnonzero(page_mask[self.row_pages])
+
+    def scatter_page_scores(self, rows: np.ndarray, row_scores: np.ndarray) -> np.ndarray:
+        '''
+        Per-page maxima of the scores of some rows, row_scores holding one
+        column per query when several queries are scored at once. Pages
+        without a scored row score -inf.
+        '''
+        page_scores = np.full((self.page_count,) + row_scores.shape[1:], -np.inf, dtype=np.float32)
+        np.maximum.at(page_scores, self.row_pages[rows], row_scores)
+        return page_scores
+
+    def page_embeddings(self, page_ids: list) -> list:
+        '''
+        The normalized embeddings of the given pages, as (page_id, embeddings)
+        pairs, skipping pages not in the index
+        '''
+        pages = []
+        for page_id in page_ids:
+            i = self.page_positions.get(page_id)
+            if i is None:
+                continue
+            end = self.page_offsets[i + 1] if i + 1 < self.page_count else self.row_count
+            pages.append((page_id, self.matrix[self.page_offsets[i]:end]))
+        return pages
+
+    def subset(self, page_ids: list) -> 'EmbeddingIndex':
+        '''
+        An exact index over only the given pages
+        '''
+        return EmbeddingIndex.from_pages(self.page_embeddings(page_ids), normalized=True)
+
+    def with_ann(self, ann) -> 'EmbeddingIndex':
+        return EmbeddingIndex(self.matrix, self.page_ids, self.page_offsets, ann)
+
+    def with_page(self, page_id, embeddings, normalized: bool = False) -> 'EmbeddingIndex':
+        '''
+        Return a new index with the embeddings of one more page appended.
+        Indexes are never mutated, so readers holding this one are unaffected.
+        '''
+        block = np.array(embeddings, dtype=np.float32, ndmin=2)
+        if not normalized:
+            normalize_rows(block)
+        if block.size == 0:
+            return self
+        if self.page_count == 0:
+            return EmbeddingIndex(block, [page_id], np.zeros(1, dtype=np.intp))
+
+        # the matrix is only appended to, so the ann index stays valid
+        return EmbeddingIndex(
+            np.vstack([self.matrix, block]),
+            self.page_ids + [page_id],
+            np.append(self.page_offsets, self.matrix.shape[0]),
+            self.ann
+        )
+
+    def page_scores(self, query_embeddings: list[list[float]], page_mask: np.ndarray = None) -> np.ndarray:
+        '''
+        Score every page against the query, a page's score being the highest
+        score of any of its embeddings. With a page_mask only the rows of the
+        selected pages are scored, the other pages score -inf.
+        '''
+        query = query_vector(query_embeddings)
+        if page_mask is None:
+            return np.maximum.reduceat(self.matrix @ query, self.page_offsets)
+
+        rows = self.masked_rows(page_mask)
+        return self.scatter_page_scores(rows, self.matrix[rows] @ query)
+
+    def top_k(self, page_scores: np.ndarray, top_k: int) -> list[dict]:
+        '''
+        Pick the top_k highest scoring pages with a partial sort, returned in
+        descending order of score
+        '''
+        k = min(top_k, len(page_scores))
+        if k <= 0:
+            return []
+
+        # pages skipped by an approximate search score -inf
+        k = min(k, int(np.isfinite(page_scores).sum()))
+        if k == 0:
+            return []
+
+        if k < len(page_scores):
+            candidates = np.argpartition(-page_scores, k - 1)[:k]
+        else:
+            candidates = np.arange(len(page_scores))
+        candidates = candidates[np.argsort(
+            -page_scores[candidates], kind='stable')]
+
+        return [{
+            'rag_page_id': self.page_ids[i],
+            'similarity_score': float(page_scores[i])
+        } for i in candidates]
+
+    def search(self, query_embeddings: list[list[float]], top_k: int = 5, exact: bool = False, nprobe: int = 8,
+               page_mask: np.ndarray = None) -> list[dict]:
+        '''
+        The top_k pages most similar to the query, optionally only among the
+        pages selected by page_mask (see page_mask())
+        '''
+        if self.page_count == 0:
+            return []
+        if page_mask is not None and self.ann is not None and not exact:
+            # a small scope is cheaper to scan exactly than through the probed
+            # lists, which may hold few of its rows anyway
+            exact = len(self.masked_rows(page_mask)) <= self.ann.scanned_rows(nprobe)
+        if self.ann is None or exact:
+            return self.top_k(self.page_scores(query_embeddings, page_mask), top_k)
+        return self.top_k(self.ann.page_scores(self, query_embeddings, nprobe, page_mask), top_k)
+
+    def search_batch(self, queries_embeddings: list, top_k: int = 5, exact: bool = False, nprobe: int = 8,
+                     page_mask: np.ndarray = None) -> list[list[dict]]:
+        '''
+        search() for several queries at once. Exact searches score every query
+        in a single pass over the matrix, as one matrix-matrix product.
+        '''
+        if self.page_count == 0:
+            return [[] for _ in queries_embeddings]
+        if self.ann is not None and not exact:
+            return [self.search(query_embeddings, top_k, nprobe=nprobe, page_mask=page_mask)
+                    for query_embeddings in queries_embeddings]
+
+        queries = np.stack([query_vector(query_embeddings)
+                           for query_embeddings in queries_embeddings], axis=1)
+        if page_mask is None:
+            page_scores = np.maximum.reduceat(self.matrix @ queries, self.page_offsets, axis=0)
+        else:
+            rows = self.masked_rows(page_mask)
+            page_scores = self.scatter_page_scores(rows, self.matrix[rows] @ queries)
+
+        return [self.top_k(page_scores[:, i], top_k) for i in range(page_scores.shape[1])]
@@ -0,0 +1,107 @@
+import math
+import re
+from collections import Counter
+
+from django.apps import apps
+from django.conf import settings
+from django.db.models import Avg, Count
+
+from rag.utils.indexCache import get_generation
+from rag.utils.queryCache import query_cache
+
+# BM25 parameters, the common defaults
+K1 = 1.2
+B = 0.75
+
+# words too common to help ranking, kept out of the postings table
+STOPWORDS = frozenset('''
+a about an and are as at be but by can for from has have in into is it its
+of on or that the their there these this to was were which will with
+'''.split())
+
+# words, numbers and identifiers such as part numbers (XJ-2045, v1.2.3)
+TOKEN_PATTERN = re.compile(r"\w+(?:[-./]\w+)*")
+
+# longest term RAGPagePosting.term can hold
+MAX_TERM_LENGTH = 64
+
+
+def tokenize(text: str) -> list[str]:
+    return [token for token in TOKEN_PATTERN.findall(text.casefold())
+            if token not in STOPWORDS and len(token) <= MAX_TERM_LENGTH]
+
+
+def term_frequencies(text: str) -> tuple[int, Counter]:
+    '''
+    The token count and per-term frequencies of a page summary, as stored in
+    RAGPage.token_count and RAGPagePosting
+    '''
+    tokens = tokenize(text)
+    return len(tokens), Counter(tokens)
+
+
+def corpus_stats(organization_id) -> tuple[int, float]:
+    '''
+    The number of pages and average page length of the completely ingested
+    files of an organization, cached per index generation like query results
+    '''
+    key = f"rag:bm25-corpus:{organization_id}:{get_generation(organization_id)}"
+    cache = query_cache()
+    stats = cache.get(key)
+    if stats is not None:
+        return stats
+
+    RAGPage = apps.get_model('rag', 'RAGPage')
+    corpus = RAGPage.objects.filter(
+        rag_file_profile__organization_id=organization_id, rag_file_profile__status='complete').aggregate(
+        page_count=Count('id'), average_length=Avg('token_count'))
+    stats = (corpus['page_count'], corpus['average_length'] or 1)
+    cache.set(key, stats, timeout=settings.RAG_QUERY_RESULT_CACHE_TTL)
+    return stats
+
+
+def bm25_search(organization_id, query: str, limit: int, page_ids=None) -> list[tuple]:
+    '''
+    Rank the RAG pages of an organization against the query with BM25 over
+    their summaries, returning up to limit (rag_page_id, score) pairs, best
+    first. page_ids optionally restricts the pages ranked.
+    '''
+    terms = set(tokenize(query))
+    if not terms:
+        return []
+
+    RAGPagePosting = apps.get_model('rag', 'RAGPagePosting')
+
+    page_count, average_length = corpus_stats(organization_id)
+
+    postings = RAGPagePosting.objects.filter(
+        organization_id=organization_id, term__in=terms, rag_page__rag_file_profile__status='complete')
+    postings = list(postings.values_list(
+        'term', 'rag_page_id', 'frequency', 'rag_page__token_count'))
+
+    # document frequencies come from the whole organization, even when scoped
+    document_frequency = Counter(term for term, _, _, _ in postings)
+    if page_ids is not None:
+        page_ids = set(page_ids)
+        postings = [posting for posting in postings if posting[1] in page_ids]
+
+    scores = Counter()
+    for term, page_id, frequency, length in postings:
+        df = document_frequency[term]
+        idf = math.log(1 + (page_count - df + 0.5) / (df + 0.5))
+        scores[page_id] += idf * frequency * (K1 + 1) / \
+            (frequency + K1 * (1 - B + B * length / average_length))
+
+    return scores.most_common(limit)
+
+
+def reciprocal_rank_fusion(rankings: list[list], k: int = 60) -> list[tuple]:
+    '''
+    Fuse several rankings of ids, best first, into (id, score) pairs sorted
+    by their reciprocal rank fusion score sum(1 / (k + rank))
+    '''
+    scores = Counter()
+    for ranking in rankings:
+        for rank, item_id in enumerate(ranking, start=1):
+            scores[item_id] += 1 / (k + rank)
+    return scores.most_common()
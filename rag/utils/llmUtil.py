@@ -1,9 +1,15 @@
+import hashlib
 import os
 import re
-from together import Together
+from django.apps import apps
+from django.conf import settings
+from django.db.models import Sum
+from django.utils import timezone
+from together import AsyncTogether, Together
 from PIL.Image import Image
 
 together_client = Together()
+async_together_client = AsyncTogether()
 prompt = open("rag/utils/prompt.txt", "r").read()
 
 # using the same model because pricing is the same and it supports images
@@ -20,52 +26,124 @@ def debug_print(text):
         print(f"\033[93m{text}\033[0m")
 
 
-def summarize_text(text: str) -> str:
-    debug_print("Starting text summarization...")
-    response = together_client.chat.completions.create(
-        model=textOnly_model,
-        messages=[
-            {"role": "user", "content": prompt + "\n\n" + text}
-        ],
-        max_tokens=max_tokens
-    )
-    debug_print("Received response for text summarization.")
-    return response.choices[0].message.content
-
-
-def summarize_text_with_image(text: str, image_base64: str) -> str:
-    debug_print("Starting text and image summarization...")
-
-    # send to LLM
-    response = together_client.chat.completions.create(
-        model=visualLLM_model,
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{image_base64}",
+def summarize_text(text: str, use_cache: bool = True) -> str:
+    def create():
+        debug_print("Starting text summarization...")
+        response = together_client.chat.completions.create(
+            model=textOnly_model,
+            messages=[
+                {"role": "user", "content": prompt + "\n\n" + text}
+            ],
+            max_tokens=max_tokens
+        )
+        debug_print("Received response for text summarization.")
+        return response.choices[0].message.content
+
+    return cached_response(textOnly_model, [text], create, use_cache)
+
+
+def summarize_text_with_image(text: str, image_base64: str, mime_type: str = 'image/jpeg', use_cache: bool = True) -> str:
+    def create():
+        debug_print("Starting text and image summarization...")
+
+        # send to LLM
+        response = together_client.chat.completions.create(
+            model=visualLLM_model,
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": prompt},
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": f"data:{mime_type};base64,{image_base64}",
+                            },
                         },
-                    },
-                ],
-            }
-        ],
-        max_tokens=max_tokens
-    )
-    debug_print("Received response for text and image summarization.")
-    return response.choices[0].message.content
+                    ],
+                }
+            ],
+            max_tokens=max_tokens
+        )
+        debug_print("Received response for text and image summarization.")
+        return response.choices[0].message.content
+
+    return cached_response(visualLLM_model, [text, image_base64], create, use_cache)
+
+
+def llm_response_key(model: str, inputs: list[str]) -> str:
+    '''
+    Key of an LLM response: the model, max_tokens, and the hashes of the
+    prompt and of every input
+    '''
+    prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+    input_hashes = [hashlib.sha256(value.encode('utf-8')).hexdigest() for value in inputs]
+    key = '\n'.join([model, str(max_tokens), prompt_hash] + input_hashes)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def cached_response(model: str, inputs: list[str], create, use_cache: bool = True) -> str:
+    '''
+    The stored response to the same request if there is one, otherwise the
+    result of create(), stored for the next time. Pass use_cache=False, or set
+    RAG_LLM_CACHE_ENABLED to False, to always call create().
+    '''
+    if not (use_cache and settings.RAG_LLM_CACHE_ENABLED):
+        return create()
+
+    LLMResponse = apps.get_model('rag', 'LLMResponse')
+    key = llm_response_key(model, inputs)
+
+    cached = LLMResponse.objects.filter(key=key).only('response').first()
+    if cached is not None:
+        debug_print("Reusing a stored LLM response.")
+        LLMResponse.objects.filter(id=cached.id).update(last_used_at=timezone.now())
+        return cached.response
+
+    response = create()
+    LLMResponse.objects.get_or_create(key=key, defaults={
+        'model': model,
+        'response': response,
+        'size': len(response.encode('utf-8')),
+    })
+    return response
+
+
+def evict_llm_responses(max_bytes: int = None) -> int:
+    '''
+    Delete the least recently used stored LLM responses until they take at
+    most max_bytes (RAG_LLM_CACHE_MAX_BYTES by default), returning the number
+    of deleted responses
+    '''
+    LLMResponse = apps.get_model('rag', 'LLMResponse')
+    if max_bytes is None:
+        max_bytes = settings.RAG_LLM_CACHE_MAX_BYTES
+
+    excess = (LLMResponse.objects.aggregate(total=Sum('size'))['total'] or 0) - max_bytes
+    if excess <= 0:
+        return 0
+
+    evicted = []
+    for response_id, size in LLMResponse.objects.order_by('last_used_at').values_list('id', 'size').iterator():
+        if excess <= 0:
+            break
+        evicted.append(response_id)
+        excess -= size
+
+    deleted = 0
+    for start in range(0, len(evicted), 1000):
+        deleted += LLMResponse.objects.filter(id__in=evicted[start:start + 1000]).delete()[0]
+    return deleted
 
 
 embedding_model = "BAAI/bge-base-en-v1.5"
 embedding_dimensions = 768
 embedding_max_tokens = 256
+# most chunks embedded by a single embeddings request
+embedding_batch_size = 128
 
 
-def generate_embeddings(text: str) -> list[list[float]]:
-    debug_print("Starting embeddings generation...")
+def text_to_chunks(text: str) -> list[str]:
     # Tokenize the text by splitting on spaces
     tokens = re.findall(r'\S+\s*', text)
 
@@ -74,16 +152,61 @@ def generate_embeddings(text: str) -> list[list[float]]:
               for i in range(0, len(tokens), embedding_max_tokens)]
 
     # convert chunks, list of tokens, to text
-    chunks = [''.join(chunk) for chunk in chunks]
-
-    response = together_client.embeddings.create(
-        model=embedding_model,
-        input=chunks
-    )
+    return [''.join(chunk) for chunk in chunks]
 
-    debug_print("Received response for embeddings.")
 
-    # Extract embeddings from the response
-    embeddings = [item.embedding for item in response.data]
+def generate_embeddings_batch(texts: list[str]) -> list[list[list[float]]]:
+    '''
+    Embed the chunks of several texts with as few embeddings requests as
+    possible, embedding_batch_size chunks each, returning the chunk
+    embeddings of every text in order
+    '''
+    debug_print("Starting embeddings generation...")
+    chunks_per_text = [text_to_chunks(text) for text in texts]
+    chunks = [chunk for text_chunks in chunks_per_text for chunk in text_chunks]
+    if not chunks:
+        return [[] for _ in texts]
+
+    embeddings = []
+    for start in range(0, len(chunks), embedding_batch_size):
+        response = together_client.embeddings.create(
+            model=embedding_model,
+            input=chunks[start:start + embedding_batch_size]
+        )
+        embeddings.extend(item.embedding for item in response.data)
 
-    return embeddings
+    debug_print("Received response for embeddings.")
+    return split_embeddings(embeddings, chunks_per_text)
+
+
+async def agenerate_embeddings_batch(texts: list[str]) -> list[list[list[float]]]:
+    '''
+    generate_embeddings_batch() awaiting the provider instead of blocking
+    the thread, for async views
+    '''
+    debug_print("Starting async embeddings generation...")
+    chunks_per_text = [text_to_chunks(text) for text in texts]
+    chunks = [chunk for text_chunks in chunks_per_text for chunk in text_chunks]
+    if not chunks:
+        return [[] for _ in texts]
+
+    embeddings = []
+    for start in range(0, len(chunks), embedding_batch_size):
+        response = await async_together_client.embeddings.create(
+            model=embedding_model,
+            input=chunks[start:start + embedding_batch_size]
+        )
+        embeddings.extend(item.embedding for item in response.data)
+
+    debug_print("Received response for async embeddings.")
+    return split_embeddings(embeddings, chunks_per_text)
+
+
+def split_embeddings(embeddings: list, chunks_per_text: list[list[str]]) -> list[list[list[float]]]:
+    # split the embeddings of all chunks back per text
+    embeddings_per_text = []
+    start = 0
+    for text_chunks in chunks_per_text:
+        embeddings_per_text.append(embeddings[start:start + len(text_chunks)])
+        start += len(text_chunks)
+    return embeddings_per_text
@@ -0,0 +1,161 @@
+import numpy as np
+
+from rag.utils.indexUtil import EmbeddingIndex, query_vector
+
+QUANTIZATION_MODES = ['int8', 'binary']
+
+# number of set bits of every byte value, to count bits of packed sign codes
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+# rows scored per block, bounding the float32 copy of int8 codes
+BLOCK_ROWS = 65536
+
+
+def quantize(block: np.ndarray, mode: str, scales: np.ndarray = None) -> np.ndarray:
+    if mode == 'int8':
+        return np.clip(np.rint(block / scales), -127, 127).astype(np.int8)
+    return np.packbits(block > 0, axis=1)
+
+
+class QuantizedIndex(EmbeddingIndex):
+    '''
+    An EmbeddingIndex whose float32 matrix is replaced by compact codes.
+
+    int8 codes hold every dimension scaled by a per-dimension factor (4x
+    smaller), binary codes hold only the sign of every dimension (32x
+    smaller). The codes give a first-pass score to every page, then the best
+    rescore_candidates pages are rescored at full precision with embeddings
+    fetched by rescore_loader, a callable mapping a list of page ids to
+    (page_id, normalized embeddings) pairs.
+    '''
+
+    def __init__(self, mode: str, codes: np.ndarray, scales: np.ndarray, page_ids: list, page_offsets: np.ndarray,
+                 rescore_loader, rescore_candidates: int = 50):
+        super().__init__(None, page_ids, page_offsets)
+        self.mode = mode
+        self.codes = codes
+        self.scales = scales
+        self.rescore_loader = rescore_loader
+        self.rescore_candidates = rescore_candidates
+
+    @classmethod
+    def from_index(cls, index: EmbeddingIndex, mode: str, rescore_loader, rescore_candidates: int = 50) -> 'QuantizedIndex':
+        if mode not in QUANTIZATION_MODES:
+            raise ValueError(f"Quantization mode {mode} is not supported")
+
+        if index.page_count == 0:
+            return cls(mode, np.zeros((0, 0), dtype=np.int8), None, [], index.page_offsets,
+                       rescore_loader, rescore_candidates)
+
+        scales = None
+        if mode == 'int8':
+            scales = np.abs(index.matrix).max(axis=0) / 127
+            scales[scales == 0] = 1
+
+        return cls(mode, quantize(index.matrix, mode, scales), scales, index.page_ids, index.page_offsets,
+                   rescore_loader, rescore_candidates)
+
+    @property
+    def row_count(self) -> int:
+        return self.codes.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.page_offsets.nbytes + 100 * self.page_count
+
+    def subset(self, page_ids: list) -> EmbeddingIndex:
+        '''
+        An exact full-precision index over only the given pages
+        '''
+        return EmbeddingIndex.from_pages(self.rescore_loader(page_ids), normalized=True)
+
+    def with_page(self, page_id, embeddings, normalized: bool = False) -> 'QuantizedIndex':
+        '''
+        Return a new index with one more page appended, quantized with the
+        existing scales. embeddings must be L2-normalized.
+        '''
+        block = np.array(embeddings, dtype=np.float32, ndmin=2)
+        if block.size == 0 or self.page_count == 0:
+            # nothing to append to, the cache rebuilds empty indexes anyway
+            return self
+
+        return QuantizedIndex(
+            self.mode,
+            np.vstack([self.codes, quantize(block, self.mode, self.scales)]),
+            self.scales,
+            self.page_ids + [page_id],
+            np.append(self.page_offsets, self.row_count),
+            self.rescore_loader,
+            self.rescore_candidates
+        )
+
+    def extended(self, index: EmbeddingIndex, rescore_loader) -> 'QuantizedIndex':
+        '''
+        Return the quantized index of index, a grown copy of the index this one
+        was quantized from, quantizing only the rows appended since with the
+        existing scales
+        '''
+        if self.page_count == 0:
+            # no scales to quantize with yet
+            return QuantizedIndex.from_index(index, self.mode, rescore_loader, self.rescore_candidates)
+
+        block = np.asarray(index.matrix[self.row_count:], dtype=np.float32)
+        return QuantizedIndex(
+            self.mode,
+            np.vstack([self.codes, quantize(block, self.mode, self.scales)]),
+            self.scales,
+            index.page_ids,
+            index.page_offsets,
+            rescore_loader,
+            self.rescore_candidates
+        )
+
+    def row_scores(self, query: np.ndarray, rows: np.ndarray = None) -> np.ndarray:
+        codes = self.codes if rows is None else self.codes[rows]
+
+        if self.mode == 'int8':
+            # codes . (query * scales) == (codes * scales) . query
+            scaled_query = query * self.scales
+            return np.concatenate([
+                codes[start:start + BLOCK_ROWS].astype(np.float32) @ scaled_query
+                for start in range(0, len(codes), BLOCK_ROWS)
+            ] or [np.zeros(0, dtype=np.float32)])
+
+        # fewer differing signs means a higher similarity
+        query_bits = np.packbits(query > 0)
+        return -np.concatenate([
+            POPCOUNT[codes[start:start + BLOCK_ROWS] ^ query_bits].sum(axis=1, dtype=np.int32)
+            for start in range(0, len(codes), BLOCK_ROWS)
+        ] or [np.zeros(0, dtype=np.int32)]).astype(np.float32)
+
+    def search(self, query_embeddings, top_k: int = 5, exact: bool = False, nprobe: int = 8,
+               page_mask: np.ndarray = None) -> list[dict]:
+        '''
+        Same results as EmbeddingIndex.search, provided the true top_k pages
+        are among the rescore_candidates best first-pass pages.
+        exact and nprobe are accepted for compatibility and ignored.
+        '''
+        if self.page_count == 0:
+            return []
+
+        query = query_vector(query_embeddings)
+        if page_mask is None:
+            page_scores = np.maximum.reduceat(
+                self.row_scores(query), self.page_offsets)
+        else:
+            rows = self.masked_rows(page_mask)
+            page_scores = self.scatter_page_scores(rows, self.row_scores(query, rows))
+
+        candidate_count = min(max(self.rescore_candidates, top_k),
+                              int(np.isfinite(page_scores).sum()))
+        if candidate_count == 0:
+            return []
+        candidates = np.argpartition(-page_scores, candidate_count - 1)[:candidate_count]
+
+        return self.subset([self.page_ids[i] for i in candidates]).search(query_embeddings, top_k)
+
+    def search_batch(self, queries_embeddings: list, top_k: int = 5, exact: bool = False, nprobe: int = 8,
+                     page_mask: np.ndarray = None) -> list[list[dict]]:
+        # every query rescores its own candidates, there is no shared pass
+        return [self.search(query_embeddings, top_k, page_mask=page_mask)
+                for query_embeddings in queries_embeddings]
@@ -0,0 +1,144 @@
+import hashlib
+import re
+
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+from rag.utils.embeddingCodec import decode_embeddings, encode_embeddings
+from rag.utils.indexCache import get_generation
+from rag.utils.llmUtil import agenerate_embeddings_batch, embedding_model, generate_embeddings_batch
+
+
+def query_cache():
+    return caches[settings.RAG_QUERY_CACHE_ALIAS]
+
+
+def normalize_query(query: str) -> str:
+    # the embedding model is uncased, so case and spacing never change the vectors
+    return re.sub(r'\s+', ' ', query).strip().casefold()
+
+
+def count(counter: str, amount: int = 1):
+    '''
+    Add amount to a shared counter, such as 'query-embedding:hits'
+    '''
+    if amount == 0:
+        return
+    cache = query_cache()
+    key = f"rag:{counter}"
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key, amount)
+    except ValueError:
+        pass
+
+
+def query_embedding_key(query: str) -> str:
+    digest = hashlib.sha256(normalize_query(query).encode('utf-8')).hexdigest()
+    return f"rag:query-embedding:{embedding_model}:{digest}"
+
+
+def get_query_embeddings(query: str) -> np.ndarray:
+    '''
+    Embeddings of a query, served from Django's cache when the same
+    normalized query was embedded within RAG_QUERY_EMBEDDING_CACHE_TTL
+    '''
+    return get_query_embeddings_batch([query])[0]
+
+
+def get_query_embeddings_batch(queries: list[str]) -> list[np.ndarray]:
+    '''
+    Embeddings of several queries, looked up in the cache together, with
+    every query missing from it embedded in a single request
+    '''
+    keys = [query_embedding_key(query) for query in queries]
+    cached, missing = lookup_query_embeddings(keys)
+
+    if missing:
+        missing_queries = dict(zip(keys, queries))
+        embeddings = generate_embeddings_batch(
+            [missing_queries[key] for key in missing])
+        cached.update(store_query_embeddings(missing, embeddings))
+
+    return [decode_embeddings(cached[key]) for key in keys]
+
+
+async def aget_query_embeddings_batch(queries: list[str]) -> list[np.ndarray]:
+    '''
+    get_query_embeddings_batch() for async views, awaiting the embedding
+    provider and running the cache round trips in a thread
+    '''
+    keys = [query_embedding_key(query) for query in queries]
+    cached, missing = await sync_to_async(lookup_query_embeddings)(keys)
+
+    if missing:
+        missing_queries = dict(zip(keys, queries))
+        embeddings = await agenerate_embeddings_batch(
+            [missing_queries[key] for key in missing])
+        cached.update(await sync_to_async(store_query_embeddings)(missing, embeddings))
+
+    return [decode_embeddings(cached[key]) for key in keys]
+
+
+def lookup_query_embeddings(keys: list[str]) -> tuple[dict, list[str]]:
+    '''
+    The cached encoded embeddings by key, and the distinct keys not cached
+    '''
+    cached = query_cache().get_many(keys)
+    missing = list(dict.fromkeys(key for key in keys if key not in cached))
+    count('query-embedding:hits', len(keys) - len(missing))
+    count('query-embedding:misses', len(missing))
+    return cached, missing
+
+
+def store_query_embeddings(keys: list[str], embeddings: list) -> dict:
+    encoded = {key: encode_embeddings(query_embeddings, model=embedding_model)
+               for key, query_embeddings in zip(keys, embeddings)}
+    query_cache().set_many(encoded, timeout=settings.RAG_QUERY_EMBEDDING_CACHE_TTL)
+    return encoded
+
+
+def query_embedding_cache_stats() -> dict:
+    return cache_stats('query-embedding')
+
+
+def query_result_cache_stats() -> dict:
+    return cache_stats('query-result')
+
+
+def cache_stats(cache_name: str) -> dict:
+    cache = query_cache()
+    return {
+        'hits': cache.get(f"rag:{cache_name}:hits", 0),
+        'misses': cache.get(f"rag:{cache_name}:misses", 0),
+    }
+
+
+def query_result_key(organization_id, generation: int, query: str, top_k: int, scope=None) -> str:
+    digest = hashlib.sha256(
+        f"{normalize_query(query)}\n{top_k}\n{scope or ''}".encode('utf-8')).hexdigest()
+    return f"rag:query-result:{organization_id}:{generation}:{digest}"
+
+
+def get_query_results(organization_id, query: str, top_k: int, scope=None) -> tuple[str, list]:
+    '''
+    Look up the results of a query, scope being the directory id the query
+    is restricted to, if any. Returns the key to store the results under with
+    set_query_results, and the cached results or None.
+
+    Keys include the organization's index generation, read before the
+    results are computed, so results can never outlive a page being added or
+    removed: the generation changes and the stale entries are never read.
+    '''
+    key = query_result_key(organization_id, get_generation(
+        organization_id), query, top_k, scope)
+    results = query_cache().get(key)
+    count('query-result:hits' if results is not None else 'query-result:misses')
+    return key, results
+
+
+def set_query_results(key: str, results: list):
+    # the TTL only reclaims entries of old generations, it is not needed for correctness
+    query_cache().set(key, results, timeout=settings.RAG_QUERY_RESULT_CACHE_TTL)
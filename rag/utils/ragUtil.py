@@ -1,13 +1,19 @@
-import itertools
-import numpy as np
 from PIL.Image import Image
-from pdf2image import convert_from_path
+from pdf2image import convert_from_path, pdfinfo_from_path
 import os
 import base64
 import io
+import hashlib
+import subprocess
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import NamedTuple
+
+from django.conf import settings
+from django.db import connections
 
 from filesystem.models import FileModel
-from rag.utils.llmUtil import summarize_text, summarize_text_with_image, generate_embeddings
+from rag.utils.llmUtil import summarize_text, summarize_text_with_image, generate_embeddings_batch
+from rag.utils.throttleUtil import cache_semaphore
 
 
 def debug_print(message: str):
@@ -15,102 +21,238 @@ def debug_print(message: str):
         print(f"\033[92m{message}\033[0m")  # ANSI escape code for green
 
 
-def txt_to_summary(txtFilePath: str) -> str:
-    debug_print(f"Reading text file from {txtFilePath}")
-    with open(txtFilePath, 'r') as file:
-        text = file.read()
-    debug_print("Summarizing text")
-    return summarize_text(text)
+class PageSummary(NamedTuple):
+    summary: str
+    # 'text' if the summary was made from the text of the page,
+    # 'image' if it was made from an image of the page by the vision model
+    source: str
+    # hash of the text or image the summary was made from, see page_hash
+    content_hash: str = ''
+    # encoded embeddings of the summary, when reused from an identical page
+    embeddings: bytes = None
 
 
-def pdf_to_summaries_per_page(pdfFilePath: str) -> list[str]:
-    debug_print(f"Generating summaries for each page in {pdfFilePath}")
+def page_hash(source: str, content: str) -> str:
+    return hashlib.sha256(f"{source}:{content}".encode('utf-8')).hexdigest()
+
+
+def summarize_in_thread(summarize, content: str, content_hash: str) -> PageSummary:
+    try:
+        return summarize(content, content_hash)
+    finally:
+        # pool threads open their own connections to the stored LLM responses,
+        # which Django never closes
+        connections.close_all()
+
+
+def summary_future(executor, summarize, content: str, content_hash: str, find_page=None) -> Future:
+    '''
+    Summarize page content on the executor, unless find_page, a callable
+    mapping a content hash to the PageSummary of an identical page or None,
+    finds one to reuse
+    '''
+    reused = find_page(content_hash) if find_page else None
+    if reused is None:
+        return executor.submit(summarize_in_thread, summarize, content, content_hash)
+
+    debug_print("Reusing the summary of an identical page")
+    future = Future()
+    future.set_result(reused)
+    return future
+
+
+# mime types of the image formats pages can be encoded in
+IMAGE_MIME_TYPES = {
+    'JPEG': 'image/jpeg',
+    'WEBP': 'image/webp',
+    'PNG': 'image/png',
+}
+
+
+def render_pages(pdfFilePath: str, first_page: int, last_page: int, dpi: int = None) -> list[Image]:
+    return convert_from_path(pdfFilePath, dpi=dpi or settings.RAG_RENDER_DPI,
+                             first_page=first_page, last_page=last_page)
 
-    images = convert_from_path(pdfFilePath)
 
-    base64_images = []
+def encode_image(img: Image, image_format: str = None, quality: int = None, max_dimension: int = None) -> str:
+    '''
+    Downscale a page image to fit in max_dimension pixels and encode it as
+    base64 in image_format, defaulting to RAG_RENDER_MAX_DIMENSION,
+    RAG_IMAGE_FORMAT and RAG_IMAGE_QUALITY
+    '''
+    image_format = image_format or settings.RAG_IMAGE_FORMAT
+    quality = quality or settings.RAG_IMAGE_QUALITY
+    max_dimension = max_dimension or settings.RAG_RENDER_MAX_DIMENSION
 
-    # Iterate through the list of images
-    for img in images:
-        # Create a BytesIO object to hold the image
-        buffered = io.BytesIO()
+    # keeps the aspect ratio, and never upscales
+    img.thumbnail((max_dimension, max_dimension))
+    if image_format != 'PNG' and img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
 
-        # Save the image to the BytesIO object in PNG format
-        img.save(buffered, format="PNG")
+    # Create a BytesIO object to hold the image
+    buffered = io.BytesIO()
 
-        # Get the image data from the BytesIO object
-        img_data = buffered.getvalue()
+    # Save the image to the BytesIO object, quality is ignored by PNG
+    img.save(buffered, format=image_format, quality=quality)
 
-        # Encode the image data to Base64
-        base64_string = base64.b64encode(img_data).decode('utf-8')
+    # Encode the image data to Base64
+    return base64.b64encode(buffered.getvalue()).decode('utf-8')
 
-        # Append the Base64 string to the list
-        base64_images.append(base64_string)
 
-    summaries = []
-    for image_base64 in base64_images:
+def summarize_image(image_base64: str, content_hash: str = '') -> PageSummary:
+    # bound the LLM calls in flight across every ingestion task
+    with cache_semaphore('summaries', settings.RAG_SUMMARY_GLOBAL_CONCURRENCY):
         debug_print("Summarizing image")
-        summaries.append(summarize_text_with_image("", image_base64))
-    return summaries
+        summary = summarize_text_with_image(
+            "", image_base64, mime_type=IMAGE_MIME_TYPES[settings.RAG_IMAGE_FORMAT])
+        return PageSummary(summary, 'image', content_hash)
 
 
-def file_to_summaries(fileInstance: FileModel) -> list[str]:
-    type = fileInstance.file_type
-    debug_print(f"Processing file of type {type}")
-    if type == 'plain':
-        return [txt_to_summary(fileInstance.file.path)]
-    elif type == 'pdf':
-        return pdf_to_summaries_per_page(fileInstance.file.path)
-    else:
-        raise ValueError(f"File type {type} is not supported for RAG")
+def summarize_page_text(text: str, content_hash: str = '') -> PageSummary:
+    with cache_semaphore('summaries', settings.RAG_SUMMARY_GLOBAL_CONCURRENCY):
+        debug_print("Summarizing page text")
+        return PageSummary(summarize_text(text), 'text', content_hash)
+
+
+def pdf_page_texts(pdfFilePath: str, first_page: int, last_page: int) -> list[str]:
+    '''
+    The text layer of every page from first_page to last_page, extracted with
+    poppler's pdftotext. Pages are '' if the text cannot be extracted.
+    '''
+    page_count = last_page - first_page + 1
+    try:
+        result = subprocess.run(
+            ['pdftotext', '-layout', '-f', str(first_page), '-l', str(last_page), pdfFilePath, '-'],
+            capture_output=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return [''] * page_count
+
+    # every page ends with a form feed
+    texts = result.stdout.decode('utf-8', errors='replace').split('\f')[:page_count]
+    return texts + [''] * (page_count - len(texts))
+
+
+def is_text_rich(text: str) -> bool:
+    return len(text.strip()) >= settings.RAG_TEXT_LAYER_MIN_CHARS
+
 
+def pdf_to_summaries_per_page(pdfFilePath: str, find_page=None, first_page: int = 1,
+                              last_page: int = None) -> list[PageSummary]:
+    '''
+    Summarize every page of a PDF from first_page to last_page (1-based,
+    inclusive, the last page by default), in page order.
+
+    Pages with a text layer of at least RAG_TEXT_LAYER_MIN_CHARS characters
+    are summarized from their text. Only the other pages, scanned or mostly
+    images, are rendered and sent to the vision model.
+
+    Pages are handled RAG_RENDER_WINDOW at a time while the pages before are
+    being summarized, RAG_SUMMARY_CONCURRENCY at a time. Rendering waits when
+    that many pages are queued, so at most a few windows of images are held
+    in memory whatever the page count.
+
+    Pages identical to a page find_page finds (see summary_future) reuse its
+    summary instead of being summarized again.
+    '''
+    debug_print(f"Generating summaries for each page in {pdfFilePath}")
+
+    last_page = last_page or pdf_page_count(pdfFilePath)
+    window = settings.RAG_RENDER_WINDOW
+    max_pending = window + settings.RAG_SUMMARY_CONCURRENCY
+
+    futures = {}
+    with ThreadPoolExecutor(max_workers=settings.RAG_SUMMARY_CONCURRENCY) as executor:
+        for window_start in range(first_page, last_page + 1, window):
+            # hold back rendering until the queued pages are summarized
+            pending = [future for future in futures.values() if not future.done()]
+            while len(pending) > max_pending - window:
+                wait(pending, return_when=FIRST_COMPLETED)
+                pending = [future for future in pending if not future.done()]
 
-def summary_to_embeddings(summary: str) -> list[list[float]]:
-    debug_print("Generating embeddings for summary")
-    return generate_embeddings(summary)
+            window_end = min(window_start + window - 1, last_page)
+            texts = pdf_page_texts(pdfFilePath, window_start, window_end)
 
+            image_pages = []
+            for page, text in enumerate(texts, start=window_start):
+                if is_text_rich(text):
+                    futures[page] = summary_future(
+                        executor, summarize_page_text, text, page_hash('text', text), find_page)
+                else:
+                    image_pages.append(page)
 
-def cosine_similarity(a, b):
-    return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
+            # render each run of consecutive image pages with one pdftoppm call
+            for run_start, run_end in page_runs(image_pages):
+                debug_print(f"Rendering pages {run_start} to {run_end}")
+                images = render_pages(pdfFilePath, run_start, run_end)
+                for page, img in zip(range(run_start, run_end + 1), images):
+                    image_base64 = encode_image(img)
+                    futures[page] = summary_future(
+                        executor, summarize_image, image_base64, page_hash('image', image_base64), find_page)
 
+    return [futures[page].result() for page in sorted(futures)]
 
-def run_rag(query: str, embeddings_with_ids: list[dict], top_k: int = 5) -> list[dict]:
+
+def page_runs(pages: list[int]) -> list[tuple[int, int]]:
     '''
-    Run RAG on the query and return the most similar embeddings
-
-    Expected input:
-    {
-        'embedding': [embedding],
-        'rag_page_id': [rag_page_id]
-    }
-
-    Expected output:
-    {
-        'rag_page_id': [rag_page_id],
-        'similarity_score': [similarity_score]
-    }
+    Group sorted page numbers into (first, last) runs of consecutive pages
     '''
+    runs = []
+    for page in pages:
+        if runs and runs[-1][1] == page - 1:
+            runs[-1] = (runs[-1][0], page)
+        else:
+            runs.append((page, page))
+    return runs
+
+
+def txt_to_page_summary(txtFilePath: str, find_page=None) -> PageSummary:
+    debug_print(f"Reading text file from {txtFilePath}")
+    with open(txtFilePath, 'r') as file:
+        text = file.read()
+    content_hash = page_hash('text', text)
+
+    reused = find_page(content_hash) if find_page else None
+    if reused is not None:
+        debug_print("Reusing the summary of an identical text file")
+        return reused
+    # under the same global cap as the pages of PDFs
+    return summarize_page_text(text, content_hash)
+
 
-    query_embeddings = generate_embeddings(query)
+def pdf_page_count(pdfFilePath: str) -> int:
+    return pdfinfo_from_path(pdfFilePath)['Pages']
 
-    scores_with_ids = []
 
-    for embedding in embeddings_with_ids:
-        similarity_score = 0
-        for query_embedding in query_embeddings:
-            similarity_score += cosine_similarity(
-                np.array(query_embedding), np.array(embedding['embedding']))
-        scores_with_ids.append({
-            'rag_page_id': embedding['rag_page_id'],
-            'similarity_score': similarity_score
-        })
+def file_page_count(fileInstance: FileModel) -> int:
+    type = fileInstance.file_type
+    if type == 'plain':
+        return 1
+    elif type == 'pdf':
+        return pdf_page_count(fileInstance.file.path)
+    else:
+        raise ValueError(f"File type {type} is not supported for RAG")
+
 
-    # some pages have multiple embeddings, we should only keep the highest similarity score
-    scores_with_ids = [max(group, key=lambda x: x['similarity_score'])
-                       for _, group in itertools.groupby(scores_with_ids, key=lambda x: x['rag_page_id'])]
+def file_to_summaries(fileInstance: FileModel, find_page=None, first_page: int = 1,
+                      last_page: int = None) -> list[PageSummary]:
+    '''
+    Summaries of the pages of a file from first_page to last_page (1-based,
+    inclusive, the last page by default). Plain text files have one page.
+    '''
+    type = fileInstance.file_type
+    debug_print(f"Processing file of type {type}")
+    if type == 'plain':
+        return [txt_to_page_summary(fileInstance.file.path, find_page)]
+    elif type == 'pdf':
+        return pdf_to_summaries_per_page(fileInstance.file.path, find_page, first_page, last_page)
+    else:
+        raise ValueError(f"File type {type} is not supported for RAG")
 
-    # sort the embeddings by similarity score
-    scores_with_ids.sort(
-        key=lambda x: x['similarity_score'], reverse=True)
 
-    return scores_with_ids[:top_k]
+def summaries_to_embeddings(summaries: list[str]) -> list[list[list[float]]]:
+    '''
+    Embeddings of every summary of a document, with the chunks of all
+    summaries sent together in batched requests
+    '''
+    debug_print(f"Generating embeddings for {len(summaries)} summaries")
+    return generate_embeddings_batch(summaries)
@@ -0,0 +1,138 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connections
+
+from rag.utils.indexCache import get_organization_index
+from rag.utils.lexicalUtil import bm25_search, reciprocal_rank_fusion
+from rag.utils.queryCache import get_query_embeddings, get_query_embeddings_batch
+
+
+def directory_page_ids(directory) -> list:
+    '''
+    The ids of the RAG pages of every completely ingested file in the subtree
+    of a directory, selected in one query through the materialized path prefix
+    '''
+    RAGPage = apps.get_model('rag', 'RAGPage')
+    return list(RAGPage.objects.filter(
+        rag_file_profile__organization_id=directory.organization_id,
+        rag_file_profile__status='complete',
+        rag_file_profile__file__directory__path__startswith=directory.path
+    ).order_by().values_list('id', flat=True))
+
+
+def search_organization(query: str, organization_id, top_k: int = 5, page_ids: list = None) -> list[dict]:
+    '''
+    Run a query against the RAG store of an organization, optionally only
+    among the pages in page_ids, returning the top_k pages in the format of:
+    {
+        'rag_page_id': rag_page_id,
+        'similarity_score': cosine similarity with the query,
+        'lexical_score': BM25 score of the page summary, or None,
+        'fused_score': reciprocal rank fusion score the results are ranked by
+    }
+
+    Without RAG_HYBRID_SEARCH only embedding similarity is used and the
+    results hold just rag_page_id and similarity_score.
+    '''
+    return search_organization_batch([query], organization_id, top_k, page_ids)[0]
+
+
+def search_organization_batch(queries: list[str], organization_id, top_k: int = 5, page_ids: list = None,
+                              queries_embeddings: list = None, hybrid: bool = None) -> list[list[dict]]:
+    '''
+    search_organization() for several queries, returning one result list per
+    query. The queries are embedded in a single request, unless their
+    embeddings are given, and the ones scored against the whole index share
+    one pass over its matrix. hybrid overrides RAG_HYBRID_SEARCH.
+    '''
+    index = get_organization_index(organization_id)
+    if queries_embeddings is None:
+        queries_embeddings = get_query_embeddings_batch(queries)
+    page_mask = index.page_mask(page_ids) if page_ids is not None else None
+
+    if not (settings.RAG_HYBRID_SEARCH if hybrid is None else hybrid):
+        return index.search_batch(queries_embeddings, top_k, nprobe=settings.RAG_ANN_NPROBE, page_mask=page_mask)
+
+    candidate_count = max(top_k, settings.RAG_HYBRID_CANDIDATES)
+    prune = index.page_count >= settings.RAG_LEXICAL_PRUNE_MIN_PAGES
+    lexical_limit = max(candidate_count, settings.RAG_LEXICAL_PRUNE_CANDIDATES if prune else 0)
+    lexical = [bm25_search(organization_id, query, lexical_limit, page_ids) for query in queries]
+
+    vector = [None] * len(queries)
+    unpruned = []
+    for i, query_embeddings in enumerate(queries_embeddings):
+        if prune and len(lexical[i]) >= top_k:
+            # big organization with enough lexical matches, only score those
+            scanned_index = index.subset([page_id for page_id, _ in lexical[i]])
+            vector[i] = scanned_index.search(query_embeddings, candidate_count)
+        else:
+            unpruned.append(i)
+
+    if unpruned:
+        results = index.search_batch([queries_embeddings[i] for i in unpruned], candidate_count,
+                                     nprobe=settings.RAG_ANN_NPROBE, page_mask=page_mask)
+        for i, result in zip(unpruned, results):
+            vector[i] = result
+
+    return [fuse_results(index, queries_embeddings[i], vector[i], lexical[i][:candidate_count], top_k)
+            for i in range(len(queries))]
+
+
+def search_organizations(query: str, organization_ids: list, top_k: int = 5) -> list[dict]:
+    '''
+    Run a query against the RAG stores of several organizations, returning
+    the global top_k pages by similarity, each result being a vector only
+    search_organization() result with the 'organization_id' it comes from.
+
+    The query is embedded once and the organizations are scored in parallel
+    on RAG_FEDERATED_SEARCH_WORKERS threads, numpy releasing the GIL. Every
+    organization is ranked and merged on similarity_score, the only score
+    comparable across organizations: BM25 and fused scores depend on each
+    organization's corpus.
+    '''
+    queries_embeddings = [get_query_embeddings(query)]
+
+    def search(organization_id):
+        try:
+            results = search_organization_batch(
+                [query], organization_id, top_k, queries_embeddings=queries_embeddings, hybrid=False)[0]
+        finally:
+            # pool threads open their own connections, which Django never closes
+            connections.close_all()
+        for result in results:
+            result['organization_id'] = organization_id
+        return results
+
+    with ThreadPoolExecutor(max_workers=settings.RAG_FEDERATED_SEARCH_WORKERS) as executor:
+        results = [result for org_results in executor.map(search, organization_ids)
+                   for result in org_results]
+
+    results.sort(key=lambda result: result['similarity_score'], reverse=True)
+    return results[:top_k]
+
+
+def fuse_results(index, query_embeddings, vector: list[dict], lexical: list, top_k: int) -> list[dict]:
+    '''
+    Merge the vector and lexical rankings of a query with reciprocal rank
+    fusion, into the top_k results of search_organization()
+    '''
+    similarity_scores = {r['rag_page_id']: r['similarity_score'] for r in vector}
+    lexical_scores = dict(lexical)
+
+    fused = reciprocal_rank_fusion(
+        [list(similarity_scores), list(lexical_scores)], k=settings.RAG_RRF_K)[:top_k]
+
+    # pages only found lexically still get their exact similarity score
+    missing = [page_id for page_id, _ in fused if page_id not in similarity_scores]
+    if missing:
+        for result in index.subset(missing).search(query_embeddings, len(missing)):
+            similarity_scores[result['rag_page_id']] = result['similarity_score']
+
+    return [{
+        'rag_page_id': page_id,
+        'similarity_score': similarity_scores.get(page_id),
+        'lexical_score': lexical_scores.get(page_id),
+        'fused_score': fused_score
+    } for page_id, fused_score in fused]
@@ -0,0 +1,293 @@
+'''
+Per-organization embedding shards on disk, shared by every worker process
+through memory mapping.
+
+A shard lives in RAG_SHARD_ROOT/<organization_id>/<build_id>/, and the
+CURRENT file next to the builds names the build in use:
+
+    shard.json      {"dim": embedding dimensions}
+    embeddings.f32  normalized little-endian float32 rows, page after page
+    pages.txt       one "<page_id> <first_row> <row_count>" line per page
+    ann.npz         the IVF index over the first rows, once the shard is large
+                    enough, trained by the shard tasks (see write_ann)
+
+pages.txt is written after the rows it describes, so readers only ever map
+rows that are completely written.
+'''
+
+import json
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+from typing import NamedTuple
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+
+from rag.utils.annUtil import IVFIndex
+from rag.utils.indexUtil import EmbeddingIndex
+
+CURRENT_FILE = 'CURRENT'
+META_FILE = 'shard.json'
+MATRIX_FILE = 'embeddings.f32'
+PAGES_FILE = 'pages.txt'
+ANN_FILE = 'ann.npz'
+
+
+def shard_root(organization_id) -> str:
+    return os.path.join(settings.RAG_SHARD_ROOT, str(organization_id))
+
+
+def current_shard_dir(organization_id) -> str:
+    '''
+    The directory of the organization's current shard build, or None if the
+    organization has no shard yet
+    '''
+    root = shard_root(organization_id)
+    try:
+        with open(os.path.join(root, CURRENT_FILE)) as file:
+            return os.path.join(root, file.read().strip())
+    except FileNotFoundError:
+        return None
+
+
+@contextmanager
+def shard_lock(organization_id, timeout: int = 300):
+    '''
+    Serialize shard writers across processes and hosts through Django's cache
+    '''
+    key = f"rag:shard-lock:{organization_id}"
+    while not cache.add(key, 1, timeout=timeout):
+        time.sleep(0.1)
+    try:
+        yield
+    finally:
+        cache.delete(key)
+
+
+def read_pages_after(shard_dir: str, offset: int) -> tuple[list[tuple[str, int, int]], int]:
+    '''
+    The pages.txt lines from byte offset on, and the offset right after the
+    last complete line
+    '''
+    with open(os.path.join(shard_dir, PAGES_FILE), 'rb') as file:
+        file.seek(offset)
+        lines = file.read().split(b'\n')
+
+    # the last element is an unterminated line still being written, or b''
+    pages = []
+    for line in lines[:-1]:
+        page_id, first_row, row_count = line.decode('ascii').split(' ')
+        pages.append((page_id, int(first_row), int(row_count)))
+        offset += len(line) + 1
+    return pages, offset
+
+
+def read_pages(shard_dir: str) -> list[tuple[str, int, int]]:
+    return read_pages_after(shard_dir, 0)[0]
+
+
+def write_rows(matrix_file, pages_file, pages, first_row: int, dim: int = None) -> tuple[int, int]:
+    '''
+    Write (page_id, normalized embeddings) pairs of dim dimensions, the
+    dimensions of the first page by default. Returns the next free row and
+    dim, None if it was not given and nothing was written.
+    '''
+    row = first_row
+    page_lines = []
+    for page_id, embeddings in pages:
+        block = np.ascontiguousarray(embeddings, dtype='<f4')
+        if block.size == 0:
+            continue
+        block = block.reshape(-1, block.shape[-1])
+        if dim is None:
+            dim = block.shape[1]
+        elif block.shape[1] != dim:
+            raise ValueError(f"Page {page_id} has {block.shape[1]} dimensional embeddings, the shard holds {dim}")
+        matrix_file.write(block.tobytes())
+        page_lines.append(f"{page_id} {row} {block.shape[0]}\n")
+        row += block.shape[0]
+
+    matrix_file.flush()
+    os.fsync(matrix_file.fileno())
+    pages_file.write(''.join(page_lines))
+    pages_file.flush()
+    return row, dim
+
+
+def write_shard(organization_id, pages, dim: int):
+    '''
+    Write a new shard build from (page_id, normalized embeddings) pairs and
+    make it current. The shard takes the dimensions of the stored embeddings,
+    dim only applies to a shard without any. Older builds are removed;
+    processes that still map them keep reading the unlinked files until they
+    reload.
+    '''
+    root = shard_root(organization_id)
+    build_id = uuid.uuid4().hex
+    build_dir = os.path.join(root, build_id)
+    os.makedirs(build_dir)
+
+    with open(os.path.join(build_dir, MATRIX_FILE), 'wb') as matrix_file, \
+            open(os.path.join(build_dir, PAGES_FILE), 'w') as pages_file:
+        _, rows_dim = write_rows(matrix_file, pages_file, pages, 0)
+    with open(os.path.join(build_dir, META_FILE), 'w') as file:
+        json.dump({'dim': rows_dim or dim}, file)
+
+    current_tmp = os.path.join(root, f"{CURRENT_FILE}.{build_id}")
+    with open(current_tmp, 'w') as file:
+        file.write(build_id)
+    os.replace(current_tmp, os.path.join(root, CURRENT_FILE))
+
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if name != build_id and os.path.isdir(path):
+            # mapped files cannot be removed on Windows, they go next time
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def append_to_shard(organization_id, pages) -> bool:
+    '''
+    Append (page_id, normalized embeddings) pairs to the current shard,
+    skipping pages it already holds. Returns False when the organization has
+    no shard to append to, or an empty one whose dimensions may not be the
+    ones of the pages, the whole shard must then be written.
+    '''
+    shard_dir = current_shard_dir(organization_id)
+    if shard_dir is None:
+        return False
+
+    with open(os.path.join(shard_dir, META_FILE)) as file:
+        dim = json.load(file)['dim']
+    shard_pages = read_pages(shard_dir)
+    if not shard_pages:
+        return False
+    row_count = shard_pages[-1][1] + shard_pages[-1][2]
+
+    # a rebuild that ran after the pages were saved already wrote them
+    shard_page_ids = {page_id for page_id, _, _ in shard_pages}
+    pages = ((page_id, embeddings) for page_id, embeddings in pages
+             if str(page_id) not in shard_page_ids)
+
+    with open(os.path.join(shard_dir, MATRIX_FILE), 'r+b') as matrix_file, \
+            open(os.path.join(shard_dir, PAGES_FILE), 'a') as pages_file:
+        # drop rows a crashed writer left without a pages.txt line
+        matrix_file.truncate(row_count * dim * 4)
+        matrix_file.seek(0, os.SEEK_END)
+        write_rows(matrix_file, pages_file, pages, row_count, dim)
+    return True
+
+
+def write_ann(shard_dir: str, ann: IVFIndex):
+    '''
+    Store the IVF index of a shard build, replacing the previous one at once
+    '''
+    ann_tmp = os.path.join(shard_dir, f"{ANN_FILE}.{uuid.uuid4().hex}")
+    with open(ann_tmp, 'wb') as file:
+        np.savez(file, centroids=ann.centroids, list_offsets=ann.list_offsets,
+                 list_rows=ann.list_rows, row_count=ann.row_count)
+    os.replace(ann_tmp, os.path.join(shard_dir, ANN_FILE))
+
+
+def read_ann(shard_dir: str) -> IVFIndex:
+    try:
+        with np.load(os.path.join(shard_dir, ANN_FILE)) as data:
+            return IVFIndex(data['centroids'], data['list_offsets'], data['list_rows'], int(data['row_count']))
+    except FileNotFoundError:
+        return None
+
+
+def ann_row_count(shard_dir: str) -> int:
+    '''
+    The number of rows the stored IVF index of a shard build was trained on,
+    0 if it has none, without loading the index
+    '''
+    try:
+        with np.load(os.path.join(shard_dir, ANN_FILE)) as data:
+            return int(data['row_count'])
+    except FileNotFoundError:
+        return 0
+
+
+class ShardState(NamedTuple):
+    '''
+    What an EmbeddingIndex loaded from a shard was read from, to extend it
+    with the pages appended since (see extend_shard)
+    '''
+    organization_id: str
+    shard_dir: str
+    dim: int
+    # bytes of pages.txt already read
+    pages_size: int
+    # rows the loaded IVF index was trained on, 0 without one
+    ann_row_count: int
+
+
+def open_shard(organization_id) -> tuple[EmbeddingIndex, ShardState]:
+    '''
+    Open the organization's shard as an EmbeddingIndex whose matrix is a
+    read-only memory map, with its stored IVF index and the state to extend
+    it from later, or None if the organization has no shard
+    '''
+    shard_dir = current_shard_dir(organization_id)
+    if shard_dir is None:
+        return None
+
+    try:
+        with open(os.path.join(shard_dir, META_FILE)) as file:
+            dim = json.load(file)['dim']
+        # the IVF index is read first, the rows it covers are all in pages.txt
+        ann = read_ann(shard_dir)
+        pages, pages_size = read_pages_after(shard_dir, 0)
+    except FileNotFoundError:
+        # a rebuild replaced and removed this build since CURRENT was read
+        return open_shard(organization_id)
+
+    state = ShardState(str(organization_id), shard_dir, dim, pages_size, ann.row_count if ann else 0)
+    if not pages:
+        return EmbeddingIndex.from_pages([]), state
+
+    row_count = pages[-1][1] + pages[-1][2]
+    matrix = np.memmap(os.path.join(shard_dir, MATRIX_FILE),
+                       dtype='<f4', mode='r', shape=(row_count, dim))
+
+    return EmbeddingIndex(
+        matrix,
+        [uuid.UUID(page_id) for page_id, _, _ in pages],
+        np.array([first_row for _, first_row, _ in pages], dtype=np.intp),
+        ann
+    ), state
+
+
+def extend_shard(index: EmbeddingIndex, state: ShardState) -> tuple[EmbeddingIndex, ShardState]:
+    '''
+    Extend an index opened from a shard with the pages appended to the shard
+    since, reading only the new lines of pages.txt and mapping the grown
+    matrix again. The ann index is kept, rows past it are scanned exactly.
+    Returns None when the shard was rebuilt or its IVF index retrained
+    meanwhile, the index must then be opened again.
+    '''
+    if current_shard_dir(state.organization_id) != state.shard_dir:
+        return None
+    try:
+        if ann_row_count(state.shard_dir) != state.ann_row_count:
+            return None
+        pages, pages_size = read_pages_after(state.shard_dir, state.pages_size)
+    except FileNotFoundError:
+        return None
+    if not pages:
+        return index, state
+
+    row_count = pages[-1][1] + pages[-1][2]
+    matrix = np.memmap(os.path.join(state.shard_dir, MATRIX_FILE),
+                       dtype='<f4', mode='r', shape=(row_count, state.dim))
+
+    return EmbeddingIndex(
+        matrix,
+        index.page_ids + [uuid.UUID(page_id) for page_id, _, _ in pages],
+        np.append(index.page_offsets, [first_row for _, first_row, _ in pages]).astype(np.intp),
+        index.ann
+    ), state._replace(pages_size=pages_size)
@@ -0,0 +1,36 @@
+import time
+from contextlib import contextmanager
+
+from django.core.cache import cache
+
+
+def acquire_slot(name: str, limit: int, timeout: int = 300) -> str:
+    '''
+    Take one of limit slots shared by every process and host through Django's
+    cache without waiting, returning its key for release_slot, or None if
+    every slot is taken. Slots of a crashed holder are freed after timeout
+    seconds.
+    '''
+    for slot in range(limit):
+        key = f"rag:semaphore:{name}:{slot}"
+        if cache.add(key, 1, timeout=timeout):
+            return key
+    return None
+
+
+def release_slot(key: str):
+    cache.delete(key)
+
+
+@contextmanager
+def cache_semaphore(name: str, limit: int, timeout: int = 300):
+    '''
+    Hold one of limit slots shared through Django's cache, waiting until one
+    is free (see acquire_slot)
+    '''
+    while (key := acquire_slot(name, limit, timeout)) is None:
+        time.sleep(0.1)
+    try:
+        yield
+    finally:
+        release_slot(key)
@@ -1,3 +1,5 @@
+import json
+
 from django.shortcuts import render
 
 # Create your views here.
@@ -6,9 +8,73 @@ from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
+from django.db import connections
 from django.db.transaction import atomic
 from rag.models import RAGFileProfile, RAGPage
-from rag.utils.ragUtil import run_rag
+from filesystem.models import DirectoryModel
+from django.conf import settings
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from asgiref.sync import sync_to_async
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rag.utils.queryCache import aget_query_embeddings_batch, get_query_results, set_query_results
+from rag.utils.searchUtil import directory_page_ids, search_organization, search_organization_batch, search_organizations
+
+# results returned by the single query endpoints
+QUERY_TOP_K = 5
+
+
+def add_page_details(*result_lists: list[dict]):
+    '''
+    Add the file id, file name and page number of every result in place,
+    fetched for the results of all given lists in a single query
+    '''
+    page_details = {
+        page['id']: page for page in RAGPage.objects.filter(
+            rag_file_profile__status='complete',
+            id__in={embedding['rag_page_id'] for similar_embeddings in result_lists
+                    for embedding in similar_embeddings}
+        ).order_by().values('id', 'page_number', 'rag_file_profile__file_id', 'rag_file_profile__file__name')
+    }
+
+    for similar_embeddings in result_lists:
+        # drop results whose page was deleted since the index was built, or
+        # was found lexically while its file is still being ingested
+        similar_embeddings[:] = [
+            embedding for embedding in similar_embeddings if embedding['rag_page_id'] in page_details]
+
+        for embedding in similar_embeddings:
+            page = page_details[embedding['rag_page_id']]
+            embedding['file_id'] = page['rag_file_profile__file_id']
+            embedding['file_name'] = page['rag_file_profile__file__name']
+            embedding['file_page'] = page['page_number']
+
+
+def query_scope(user, organization_id, directory_id):
+    '''
+    Check that the user can query the organization, and look up the optional
+    directory the search is restricted to.
+    Returns (directory or None, None), or (None, error response).
+    '''
+    # check if the user has access to the organization
+    if not user.organizationRelation.filter(organization_id=organization_id).exists():
+        return None, Response({"error": "You don't have access to this organization"}, status=status.HTTP_403_FORBIDDEN)
+
+    # check if the organization has any completely ingested rag file profiles
+    if not RAGFileProfile.objects.filter(organization_id=organization_id, status='complete').exists():
+        return None, Response({"error": "This organization doesn't have any RAG file profiles"}, status=status.HTTP_404_NOT_FOUND)
+
+    # restrict the search to the pages under the directory, if one is given
+    if not directory_id:
+        return None, None
+    try:
+        directory = DirectoryModel.objects.get(
+            id=directory_id, organization_id=organization_id)
+    except DirectoryModel.DoesNotExist:
+        return None, Response({"error": "Directory does not exist in this organization"}, status=status.HTTP_404_NOT_FOUND)
+    return directory, None
 
 
 @api_view(['POST'])
@@ -22,46 +88,235 @@ def post_query(request):
     {
         "query": string;
         "organization_id": string;
+        "directory_id"?: string; // only search files in this directory's subtree
     }
     '''
 
     query = request.data.get('query')
     organization_id = request.data.get('organization_id')
+    directory_id = request.data.get('directory_id')
     user = request.user
 
-    # check if the user has access to the organization
-    if not user.organizationRelation.filter(organization_id=organization_id).exists():
-        return Response({"error": "You don't have access to this organization"}, status=status.HTTP_403_FORBIDDEN)
+    if not isinstance(query, str) or not query.strip():
+        return Response({"error": "query must be a non-empty string"}, status=status.HTTP_400_BAD_REQUEST)
+
+    directory, error = query_scope(user, organization_id, directory_id)
+    if error:
+        return error
+
+    # repeated queries on an unchanged RAG store are served from the cache
+    cache_key, similar_embeddings = get_query_results(
+        organization_id, query, QUERY_TOP_K, scope=directory and directory.id)
+    if similar_embeddings is not None:
+        return Response(similar_embeddings, status=status.HTTP_200_OK)
+
+    # run RAG
+    page_ids = directory_page_ids(directory) if directory else None
+    similar_embeddings = search_organization(
+        query, organization_id, QUERY_TOP_K, page_ids=page_ids)
+
+    # add the file and page of every result
+    add_page_details(similar_embeddings)
+
+    set_query_results(cache_key, similar_embeddings)
+    return Response(similar_embeddings, status=status.HTTP_200_OK)
 
-    # check if the organization has any rag file profiles
-    if not RAGFileProfile.objects.filter(organization_id=organization_id).exists():
-        return Response({"error": "This organization doesn't have any RAG file profiles"}, status=status.HTTP_404_NOT_FOUND)
 
-    # get the rag file profiles of the organization
-    rag_file_profiles = RAGFileProfile.objects.filter(
-        organization_id=organization_id)
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+@atomic
+def post_query_batch(request):
+    '''
+    Run several queries on the RAG store of a specific organization at once,
+    returning one result list per query, in order
 
-    # get the rag pages of the rag file profiles
-    rag_pages = RAGPage.objects.filter(
-        rag_file_profile_id__in=rag_file_profiles.values_list('id', flat=True))
+    In the json format, it should be like this:
+    {
+        "queries": string[];
+        "organization_id": string;
+        "directory_id"?: string; // only search files in this directory's subtree
+    }
+    '''
+
+    queries = request.data.get('queries')
+    organization_id = request.data.get('organization_id')
+    directory_id = request.data.get('directory_id')
+    user = request.user
 
-    # Create a list of objects containing embeddings and rag_page ids
-    embeddings_with_ids = []
-    for page in rag_pages:
-        for embedding in page.embeddings:
-            embeddings_with_ids.append({
-                'embedding': embedding,
-                'rag_page_id': page.id
-            })
+    if not isinstance(queries, list) or not queries or \
+            not all(isinstance(query, str) and query.strip() for query in queries):
+        return Response({"error": "queries must be a non-empty list of non-empty strings"},
+                        status=status.HTTP_400_BAD_REQUEST)
+    if len(queries) > settings.RAG_MAX_BATCH_QUERIES:
+        return Response({"error": f"At most {settings.RAG_MAX_BATCH_QUERIES} queries can be run at once"},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    directory, error = query_scope(user, organization_id, directory_id)
+    if error:
+        return error
+    page_ids = directory_page_ids(directory) if directory else None
+
+    # run RAG, embedding and scoring every query together
+    results = search_organization_batch(
+        queries, organization_id, page_ids=page_ids)
+
+    # add the file and page of every result
+    add_page_details(*results)
+
+    return Response(results, status=status.HTTP_200_OK)
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def post_query_federated(request):
+    '''
+    Run a query on the RAG stores of several organizations of the user at
+    once, returning the global top results with the organization of each
+
+    In the json format, it should be like this:
+    {
+        "query": string;
+        "organization_ids"?: string[]; // defaults to every organization of the user
+    }
+    '''
+
+    query = request.data.get('query')
+    organization_ids = request.data.get('organization_ids')
+    user = request.user
+
+    if not isinstance(query, str) or not query.strip():
+        return Response({"error": "query must be a non-empty string"}, status=status.HTTP_400_BAD_REQUEST)
+
+    accessible_ids = {str(organization_id) for organization_id in
+                      user.organizationRelation.values_list('organization_id', flat=True)}
+
+    # check if the user has access to every requested organization
+    if organization_ids is None:
+        organization_ids = accessible_ids
+    elif not isinstance(organization_ids, list) or not set(map(str, organization_ids)) <= accessible_ids:
+        return Response({"error": "You don't have access to these organizations"}, status=status.HTTP_403_FORBIDDEN)
+
+    # only search organizations that have rag file profiles
+    organization_ids = sorted({str(organization_id) for organization_id in RAGFileProfile.objects.filter(
+        organization_id__in=set(map(str, organization_ids)), status='complete').order_by().values_list('organization_id', flat=True).distinct()})
+    if not organization_ids:
+        return Response({"error": "These organizations don't have any RAG file profiles"}, status=status.HTTP_404_NOT_FOUND)
 
     # run RAG
-    similar_embeddings = run_rag(query, embeddings_with_ids)
+    similar_embeddings = search_organizations(query, organization_ids)
 
-    # get the rag pages of the similar embeddings
-    for embedding in similar_embeddings:
-        rag_page = RAGPage.objects.get(id=embedding['rag_page_id'])
-        embedding['file_id'] = rag_page.rag_file_profile.file.id
-        embedding['file_name'] = rag_page.rag_file_profile.file.name
-        embedding['file_page'] = rag_page.page_number
+    # add the file and page of every result
+    add_page_details(similar_embeddings)
 
     return Response(similar_embeddings, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_file_progress(request, file_id):
+    '''
+    Get the RAG ingestion progress of a file
+
+    Response:
+    {
+        "status": "processing" | "complete";
+        "pages_done": number;
+        "page_count": number;
+    }
+    '''
+
+    rag_file_profile = RAGFileProfile.objects.filter(file_id=file_id).first()
+    if rag_file_profile is None:
+        return Response({"error": "This file doesn't have a RAG file profile"}, status=status.HTTP_404_NOT_FOUND)
+
+    # check if the user has access to the file's organization
+    if not request.user.organizationRelation.filter(organization_id=rag_file_profile.organization_id).exists():
+        return Response({"error": "You don't have access to this file's organization"}, status=status.HTTP_403_FORBIDDEN)
+
+    return Response(rag_file_profile.progress(), status=status.HTTP_200_OK)
+
+
+def authenticate(request):
+    '''
+    Authenticate a plain Django request with the JWT of its Authorization
+    header, like DRF does for the other views.
+    Returns (user, None), or (None, error response).
+    '''
+    try:
+        authenticated = JWTAuthentication().authenticate(request)
+    except AuthenticationFailed as e:
+        return None, JsonResponse({"detail": e.detail}, status=e.status_code)
+    if authenticated is None:
+        return None, JsonResponse({"detail": "Authentication credentials were not provided."},
+                                  status=status.HTTP_401_UNAUTHORIZED)
+    return authenticated[0], None
+
+
+def search_organization_batch_in_thread(*args, **kwargs) -> list[list[dict]]:
+    '''
+    search_organization_batch for a thread of asgiref's shared executor
+    '''
+    try:
+        return search_organization_batch(*args, **kwargs)
+    finally:
+        # executor threads open their own connections, which Django never closes
+        connections.close_all()
+
+
+@csrf_exempt
+@require_POST
+async def post_query_async(request):
+    '''
+    Same as post_query, as an async view for ASGI servers. The event loop is
+    free while the query is embedded, and scoring runs in a worker thread,
+    so one process serves many queries waiting on the embedding provider.
+    No transaction is opened, every step only reads.
+
+    In the json format, it should be like this:
+    {
+        "query": string;
+        "organization_id": string;
+        "directory_id"?: string; // only search files in this directory's subtree
+    }
+    '''
+
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({"error": "Invalid JSON body"}, status=status.HTTP_400_BAD_REQUEST)
+
+    query = data.get('query')
+    organization_id = data.get('organization_id')
+    directory_id = data.get('directory_id')
+
+    user, error = await sync_to_async(authenticate)(request)
+    if error:
+        return error
+
+    if not isinstance(query, str) or not query.strip():
+        return JsonResponse({"error": "query must be a non-empty string"}, status=status.HTTP_400_BAD_REQUEST)
+
+    directory, error = await sync_to_async(query_scope)(user, organization_id, directory_id)
+    if error:
+        return JsonResponse(error.data, status=error.status_code)
+
+    # repeated queries on an unchanged RAG store are served from the cache
+    cache_key, similar_embeddings = await sync_to_async(get_query_results)(
+        organization_id, query, QUERY_TOP_K, scope=directory and directory.id)
+    if similar_embeddings is not None:
+        return JsonResponse(similar_embeddings, safe=False, status=status.HTTP_200_OK)
+
+    # embed without blocking the event loop
+    queries_embeddings = await aget_query_embeddings_batch([query])
+
+    # run RAG outside the thread shared by the other sync_to_async calls, so
+    # concurrent requests score in parallel, numpy releasing the GIL
+    page_ids = await sync_to_async(directory_page_ids)(directory) if directory else None
+    similar_embeddings = (await sync_to_async(search_organization_batch_in_thread, thread_sensitive=False)(
+        [query], organization_id, QUERY_TOP_K, page_ids=page_ids, queries_embeddings=queries_embeddings))[0]
+
+    # add the file and page of every result
+    await sync_to_async(add_page_details)(similar_embeddings)
+
+    await sync_to_async(set_query_results)(cache_key, similar_embeddings)
+    return JsonResponse(similar_embeddings, safe=False, status=status.HTTP_200_OK)